@@ -0,0 +1,247 @@
+# SIBS benchmark
+# generates a synthetic project, fakes the compiler and archiver, and times sibs on it
+# usage: python bench/bench.py [--units=N --sources=N --depth=N --fanout=N --nesting=N --repeat=N --jobs=N --out=file.json --keep]
+# the results are json, so they can be compared between commits
+import json
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+repodir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the fake g++/gcc writes a checksum of every input file to the output, so objects change when sources do
+fakecc = """#!/bin/sh
+out=""
+ins=""
+while [ $# -gt 0 ]; do
+    if [ "$1" = "-o" ]; then
+        out="$2"
+        shift
+    elif [ -f "$1" ]; then
+        ins="$ins $1"
+    fi
+    shift
+done
+if [ -n "$out" ]; then
+    cksum $ins < /dev/null > "$out"
+fi
+"""
+
+# the fake ar keeps one "member checksum" line per member
+fakear = """#!/bin/sh
+op="$1"
+shift
+out="$1"
+shift
+case "$op" in
+    t)
+        cut -d' ' -f1 "$out"
+        ;;
+    -d|d)
+        for m in "$@"; do
+            grep -v "^$m " "$out" > "$out.tmp"
+            mv "$out.tmp" "$out"
+        done
+        ;;
+    *)
+        touch "$out"
+        for f in "$@"; do
+            b=$(basename "$f")
+            grep -v "^$b " "$out" > "$out.tmp"
+            echo "$b $(cksum < "$f")" >> "$out.tmp"
+            mv "$out.tmp" "$out"
+        done
+        ;;
+esac
+"""
+
+class Params:
+    def __init__(self):
+        self.units = 20
+        self.sources = 5
+        self.depth = 3 # layers of dependencies, the top layer are executables
+        self.fanout = 2 # how many units of the next layer each unit depends on
+        self.nesting = 1 # how many levels of SIBS(...) imports the units are spread over
+        self.repeat = 3
+        self.jobs = 1
+
+def layerof(p: Params, i: int) -> int:
+    return i*p.depth//p.units
+
+def levelof(p: Params, i: int) -> int:
+    return i % (p.nesting+1)
+
+def leveldir(level: int) -> str:
+    return "/".join([f"nest{k}" for k in range(1, level+1)])
+
+def unitname(p: Params, i: int) -> str:
+    # the name the unit has once it is imported into the root project
+    level = levelof(p, i)
+    return "".join([f"n{k}_" for k in range(1, level+1)])+f"u{i}"
+
+def unitdeps(p: Params, i: int) -> list[int]:
+    layer = layerof(p, i)
+    below = [j for j in range(p.units) if layerof(p, j) == layer+1]
+    if len(below) == 0:
+        return []
+    return [below[(i+k) % len(below)] for k in range(min(p.fanout, len(below)))]
+
+def generate(p: Params, root: str):
+    for level in range(p.nesting+1):
+        d = os.path.join(root, leveldir(level))
+        os.makedirs(d, exist_ok=True)
+        lines = []
+        if level < p.nesting:
+            lines += [f"SIBS(n{level+1}) {{", f"    nest{level+1}", "}"]
+        for i in range(p.units):
+            if levelof(p, i) != level:
+                continue
+            ud = os.path.join(d, f"u{i}")
+            os.makedirs(ud, exist_ok=True)
+            with open(os.path.join(ud, f"u{i}.h"), "w") as f:
+                f.write(f"int u{i}_f(int x);\n")
+            for s in range(p.sources):
+                with open(os.path.join(ud, f"s{s}.cpp"), "w") as f:
+                    f.write(f"#include \"u{i}.h\"\nint u{i}_s{s}(int x) {{ return x+{s}; }}\n")
+            ty = "EXEC" if layerof(p, i) == 0 else "STATIC"
+            lines.append(f"UNIT({ty}) u{i} {{")
+            lines.append("    SOURCES {")
+            lines.append(f"        u{i}/u{i}.h")
+            for s in range(p.sources):
+                lines.append(f"        u{i}/s{s}.cpp")
+            lines.append("    }")
+            lines.append("    INCLUDE {")
+            lines.append(f"        u{i}")
+            lines.append("    }")
+            deps = unitdeps(p, i)
+            if len(deps) > 0:
+                lines.append("    DEPS {")
+                for j in deps:
+                    lines.append(f"        {unitname(p, j)}")
+                lines.append("    }")
+            lines.append("}")
+        with open(os.path.join(d, "sibs.txt"), "w") as f:
+            f.write("\n".join(lines)+"\n")
+
+def faketools(tooldir: str):
+    os.makedirs(tooldir, exist_ok=True)
+    for name, script in [("g++", fakecc), ("gcc", fakecc), ("ar", fakear)]:
+        path = os.path.join(tooldir, name)
+        with open(path, "w") as f:
+            f.write(script)
+        os.chmod(path, 0o755)
+
+def runsibs(p: Params, root: str, tooldir: str) -> dict:
+    env = dict(os.environ)
+    # sibs prefers these over what is on the PATH, which would run the real tools
+    for var in ["CC", "CXX", "AR", "LD"]:
+        env.pop(var, None)
+    env["PATH"] = tooldir+os.pathsep+env.get("PATH", "")
+    env["PYTHONPATH"] = repodir+os.pathsep+env.get("PYTHONPATH", "")
+    st = time.perf_counter()
+    a = subprocess.run([sys.executable, "-m", "sibs", ".", f"--jobs={p.jobs}"], cwd=root, env=env, capture_output=True)
+    en = time.perf_counter()
+    if a.returncode != 0:
+        print(a.stdout.decode())
+        print(a.stderr.decode())
+        print("Error: sibs failed")
+        exit(1)
+    # stdout isn't a terminal, so sibs prints a "[n/total] ..." line for every command that ran
+    # (links that turn out to be up to date don't get one)
+    commands = 0
+    for ln in a.stdout.decode().split("\n"):
+        if re.match(r"^\[\d+/\d+\] ", ln):
+            commands += 1
+    return {"seconds": en-st, "commands": commands}
+
+def touch(path: str, n: int):
+    with open(path, "a") as f:
+        f.write(f"// edit {n}\n")
+
+def bench(p: Params, root: str) -> dict:
+    tooldir = os.path.join(root, "tools")
+    proj = os.path.join(root, "proj")
+    faketools(tooldir)
+    generate(p, proj)
+    # a unit in the middle for the source edit, and one in the last layer for the header edit (it has the most users)
+    mid = [i for i in range(p.units) if layerof(p, i) == p.depth//2][0]
+    low = [i for i in range(p.units) if layerof(p, i) == p.depth-1][0]
+    midsrc = os.path.join(proj, leveldir(levelof(p, mid)), f"u{mid}", "s0.cpp")
+    lowhdr = os.path.join(proj, leveldir(levelof(p, low)), f"u{low}", f"u{low}.h")
+    results = {"cold": [], "noop": [], "edit": [], "header": []}
+    for r in range(p.repeat):
+        shutil.rmtree(os.path.join(proj, "build"), ignore_errors=True)
+        results["cold"].append(runsibs(p, proj, tooldir))
+        results["noop"].append(runsibs(p, proj, tooldir))
+        touch(midsrc, r)
+        results["edit"].append(runsibs(p, proj, tooldir))
+        touch(lowhdr, r)
+        results["header"].append(runsibs(p, proj, tooldir))
+    out = {}
+    for name, runs in results.items():
+        secs = [run["seconds"] for run in runs]
+        out[name] = {
+            "seconds": secs,
+            "min": min(secs),
+            "median": statistics.median(secs),
+            "commands": runs[-1]["commands"],
+        }
+    return out
+
+def gitcommit() -> str:
+    a = subprocess.run(["git", "rev-parse", "HEAD"], cwd=repodir, capture_output=True)
+    if a.returncode != 0:
+        return ""
+    return a.stdout.decode().strip()
+
+def main():
+    p = Params()
+    outfile = ""
+    keep = False
+    for arg in sys.argv[1:]:
+        if arg.startswith("--out="):
+            outfile = arg[len("--out="):]
+        elif arg == "--keep":
+            keep = True
+        elif arg.startswith("--") and "=" in arg and hasattr(p, arg[2:arg.find("=")]):
+            setattr(p, arg[2:arg.find("=")], int(arg[arg.find("=")+1:]))
+        else:
+            print(f"Unknown option '{arg}'")
+            exit(1)
+    if p.units < p.depth or p.depth < 1 or p.repeat < 1:
+        print("Error: need at least one unit per layer and one repeat")
+        exit(1)
+
+    root = tempfile.mkdtemp(prefix="sibsbench")
+    try:
+        scenarios = bench(p, root)
+    finally:
+        if not keep:
+            shutil.rmtree(root, ignore_errors=True)
+        else:
+            print(f"Kept benchmark project in {root}")
+
+    sys.path.insert(0, repodir)
+    from sibs._version import sibsversion
+    result = {
+        "sibsversion": sibsversion,
+        "commit": gitcommit(),
+        "python": sys.version.split()[0],
+        "params": vars(p),
+        "scenarios": scenarios,
+    }
+    if outfile == "":
+        print(json.dumps(result, indent=4))
+    else:
+        with open(outfile, "w") as f:
+            json.dump(result, f, indent=4)
+        for name, sc in scenarios.items():
+            print(f"{name}: {sc['median']:.3f}s median, {sc['commands']} commands")
+
+if __name__ == "__main__":
+    main()
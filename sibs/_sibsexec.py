@@ -0,0 +1,417 @@
+import json
+import os
+import queue
+import re
+import shlex
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# executors run batches of compile (and generator) steps, the steps in a batch never depend on each other
+# links, cmake builds and plain BUILDCMDS are always run locally by main, between batches
+# a step needs .src, .out, .cwd, .cmdlines() (the commands to run locally)
+# and .templates() (the same commands with $SRC and $OUT still in them, empty if it can't be sent to a worker)
+# .key and .label() are used for the progress and the timing history
+
+# compilers a worker is willing to run, anything else sent to it is refused
+workercompilers = ["gcc", "g++", "cc", "c++", "clang", "clang++"]
+
+# workers get a structured request (compiler, language and flags), never a command line, and make the argv themselves
+# every flag has to be allowed here, on both sides, anything that can load or run other programs or write files isn't
+workerlanguages = {"c": ".i", "c++": ".ii"}
+workerflagpatterns = [
+    r"-O[0-3sgz]?", r"-Ofast", r"-g[0-3]?", r"-ggdb[0-3]?", r"-[DU][A-Za-z_][A-Za-z0-9_]*(=.*)?", r"-std=[a-z0-9+]+",
+    r"-W[A-Za-z0-9_=+-]+", r"-w", r"-pedantic(-errors)?", r"-pthread",
+    r"-m[A-Za-z0-9_=.+-]+", r"-f[A-Za-z0-9_+-]+", r"-f(file|debug|macro)-prefix-map=[^,]*", r"-f(visibility|sanitize)=[A-Za-z0-9_,.-]+",
+]
+# -f options that load plugins, read or write files next to the output or change what runs
+workerdeniedflags = ["-fplugin", "-fdump", "-fprofile", "-fauto-profile", "-fopt-info", "-fcallgraph-info", "-fstack-usage", "-fsave-optimization-record", "-fcompare-debug"]
+
+def workerflag(flag: str) -> bool:
+    # -W options with a comma pass arguments on to the assembler, preprocessor or linker, so they never match
+    if any(flag.startswith(denied) for denied in workerdeniedflags):
+        return False
+    return any(re.fullmatch(pattern, flag) for pattern in workerflagpatterns)
+
+def workerrequest(template: str, language: str) -> dict:
+    # the compile request for a template like "gcc -O2 -I inc -c $SRC -o $OUT", None if it can't be sent
+    # include and define flags are dropped, the source is preprocessed before it is sent
+    try:
+        argv = shlex.split(template)
+    except ValueError:
+        return None
+    if len(argv) == 0 or os.path.basename(argv[0]) not in workercompilers:
+        return None
+    flags = []
+    seen = set()
+    i = 1
+    while i < len(argv):
+        arg = argv[i]
+        if arg in ("-c", "$SRC") or (arg == "-o" and i+1 < len(argv) and argv[i+1] == "$OUT"):
+            seen.add(arg)
+            i += 2 if arg == "-o" else 1
+            continue
+        if arg in ("-I", "-isystem", "-iquote", "-idirafter", "-include", "-imacros", "-D", "-U"):
+            i += 2
+            continue
+        if arg.startswith(("-I", "-isystem", "-iquote", "-idirafter", "-D", "-U")):
+            i += 1
+            continue
+        if not workerflag(arg):
+            return None
+        flags.append(arg)
+        i += 1
+    if seen != {"-c", "$SRC", "-o"}:
+        return None
+    return {"op": "compile", "compiler": os.path.basename(argv[0]), "language": language, "flags": flags}
+
+printlock = threading.Lock()
+
+def printout(text: str, progress: "Progress" = None):
+    # print the output of a command in one piece, so parallel commands don't interleave
+    # with the progress of the build it belongs to, it is printed above its status line
+    if text == "":
+        return
+    with printlock:
+        if progress != None:
+            progress.clearline()
+        print(text, end="" if text.endswith("\n") else "\n")
+        if progress != None:
+            progress.drawline()
+
+def runlocal(cmd: str, showcommands: bool = False, cwd: str = None, progress: "Progress" = None) -> int:
+    # cwd is always given by sibs, it never changes the current directory
+    a = subprocess.run(cmd, shell=True, capture_output=True, cwd=cwd)
+    out = ""
+    if showcommands:
+        out += cmd+"\n"
+    out += a.stdout.decode()+a.stderr.decode()
+    printout(out, progress)
+    return a.returncode
+
+class Progress:
+    # finished/total commands, the running ones and an ETA from how long the same commands took in earlier builds
+    # on a terminal it is a status line that is redrawn in place, otherwise every finished command gets a line
+    def __init__(self, total: int, history: dict[str, float], jobs: int = 1, tty: bool = None):
+        self.total = total
+        self.history = history
+        self.jobs = jobs
+        self.tty = sys.stdout.isatty() if tty == None else tty
+        self.done = 0
+        self.running = {} # key -> start time
+        self.timings = {} # key -> seconds, of the commands that ran in this build
+        self.remaining = 0.0 # estimated seconds of the commands that haven't started
+        self.drawn = False
+
+    def estimate(self, key: str) -> float:
+        # commands without history are assumed to take as long as the average one
+        if key in self.history:
+            return self.history[key]
+        if len(self.history) == 0:
+            return 0.0
+        return sum(self.history.values())/len(self.history)
+
+    def add(self, keys: list[str]):
+        for key in keys:
+            self.remaining += self.estimate(key)
+
+    def eta(self) -> str:
+        if len(self.history) == 0:
+            return "?"
+        now = time.monotonic()
+        left = self.remaining+sum(max(0.0, self.estimate(key)-(now-st)) for key, st in self.running.items())
+        left /= max(1, min(self.jobs, self.total-self.done))
+        return f"{int(left)//60}:{int(left)%60:02d}"
+
+    def status(self) -> str:
+        return f"[{self.done}/{self.total}] {len(self.running)} running, ETA {self.eta()}"
+
+    def clearline(self):
+        # callers hold printlock
+        if self.tty and self.drawn:
+            sys.stdout.write("\r\033[K")
+            self.drawn = False
+
+    def drawline(self):
+        if self.tty:
+            sys.stdout.write("\r\033[K"+self.status())
+            sys.stdout.flush()
+            self.drawn = True
+
+    def begin(self, key: str):
+        with printlock:
+            self.remaining = max(0.0, self.remaining-self.estimate(key))
+            self.running[key] = time.monotonic()
+            self.drawline()
+
+    def end(self, key: str, label: str, ok: bool = True):
+        with printlock:
+            st = self.running.pop(key, None)
+            self.done += 1
+            if st != None and ok:
+                self.timings[key] = time.monotonic()-st
+            if self.tty:
+                self.drawline()
+            else:
+                print(f"[{self.done}/{self.total}] {label}"+("" if ok else " (failed)"))
+
+    def external(self):
+        # before a command that prints straight to the terminal
+        with printlock:
+            self.clearline()
+            sys.stdout.flush()
+
+    def skip(self, key: str):
+        # a command that turned out to have nothing to do
+        with printlock:
+            self.remaining = max(0.0, self.remaining-self.estimate(key))
+            self.done += 1
+            self.drawline()
+
+    def finish(self):
+        with printlock:
+            self.clearline()
+            sys.stdout.flush()
+
+def runsteplocal(step, showcommands: bool = False, progress: Progress = None) -> bool:
+    for cmd in step.cmdlines():
+        if runlocal(cmd, showcommands, step.cwd, progress) != 0:
+            return False
+    return True
+
+class Executor:
+    # runs the steps one after the other, the others run them in parallel
+    def __init__(self, showcommands: bool = False):
+        self.showcommands = showcommands
+        self.progress = None
+
+    def runall(self, steps: list) -> list[bool]:
+        # returns whether each step succeeded, in the same order
+        return [self.tracked(step) for step in steps]
+
+    def runstep(self, step) -> bool:
+        return runsteplocal(step, self.showcommands, self.progress)
+
+    def tracked(self, step) -> bool:
+        if self.progress == None:
+            return self.runstep(step)
+        self.progress.begin(step.key)
+        ok = False
+        try:
+            ok = self.runstep(step)
+        finally:
+            self.progress.end(step.key, step.label(), ok)
+        return ok
+
+    def close(self):
+        pass
+
+class PoolExecutor(Executor):
+    def __init__(self, jobs: int, showcommands: bool = False):
+        super().__init__(showcommands)
+        self.jobs = jobs
+        self.pool = ThreadPoolExecutor(max_workers=jobs)
+
+    def runall(self, steps: list) -> list[bool]:
+        return list(self.pool.map(self.tracked, steps))
+
+    def close(self):
+        self.pool.shutdown()
+
+# the protocol is a 4 byte length and a json header, followed by a 4 byte length and a payload
+def sendmsg(sock: socket.socket, header: dict, payload: bytes = b""):
+    hdr = json.dumps(header).encode()
+    sock.sendall(struct.pack("!I", len(hdr))+hdr+struct.pack("!I", len(payload))+payload)
+
+def recvexact(sock: socket.socket, n: int) -> bytes:
+    data = b""
+    while len(data) < n:
+        chunk = sock.recv(min(n-len(data), 1 << 20))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        data += chunk
+    return data
+
+def recvmsg(sock: socket.socket) -> tuple[dict, bytes]:
+    hdrlen = struct.unpack("!I", recvexact(sock, 4))[0]
+    header = json.loads(recvexact(sock, hdrlen).decode())
+    paylen = struct.unpack("!I", recvexact(sock, 4))[0]
+    return (header, recvexact(sock, paylen))
+
+def parseaddr(addr: str) -> tuple[str, int]:
+    if ":" in addr:
+        host, port = addr.rsplit(":", 1)
+        return (host, int(port))
+    return ("127.0.0.1", int(addr))
+
+class WorkerHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        try:
+            header, payload = recvmsg(self.request)
+        except (ConnectionError, ValueError):
+            return
+        if header.get("op") == "ping":
+            sendmsg(self.request, {"ok": True, "jobs": self.server.jobs})
+            return
+        if header.get("op") != "compile":
+            sendmsg(self.request, {"ok": False, "error": f"unknown op '{header.get('op')}'"})
+            return
+        # the argv is made here from the request, the client only picks an allowed compiler, language and flags
+        compiler = header.get("compiler")
+        if compiler not in workercompilers:
+            sendmsg(self.request, {"ok": False, "error": f"refusing to run '{compiler}'"})
+            return
+        language = header.get("language")
+        if language not in workerlanguages:
+            sendmsg(self.request, {"ok": False, "error": f"refusing language '{language}'"})
+            return
+        flags = header.get("flags")
+        if not isinstance(flags, list) or any(not isinstance(flag, str) for flag in flags):
+            sendmsg(self.request, {"ok": False, "error": "bad flags"})
+            return
+        for flag in flags:
+            if not workerflag(flag):
+                sendmsg(self.request, {"ok": False, "error": f"refusing flag '{flag}'"})
+                return
+        suffix = workerlanguages[language]
+        with self.server.slots:
+            with tempfile.TemporaryDirectory(prefix="sibsworker") as tmp:
+                src = os.path.join(tmp, "src"+suffix)
+                out = os.path.join(tmp, "out.o")
+                with open(src, "wb") as f:
+                    f.write(payload)
+                argv = [compiler]+flags+["-c", src, "-o", out]
+                a = subprocess.run(argv, capture_output=True, cwd=tmp)
+                obj = b""
+                if a.returncode == 0 and os.path.exists(out):
+                    with open(out, "rb") as f:
+                        obj = f.read()
+                sendmsg(self.request, {"ok": True, "returncode": a.returncode, "stdout": a.stdout.decode(), "stderr": a.stderr.decode()}, obj)
+
+class WorkerServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, addr: tuple[str, int], jobs: int):
+        super().__init__(addr, WorkerHandler)
+        self.jobs = jobs
+        self.slots = threading.BoundedSemaphore(jobs)
+
+def runworker(addr: str, jobs: int):
+    # only run workers on trusted networks, they compile whatever source they are sent (with the allowed flags)
+    server = WorkerServer(parseaddr(addr), jobs)
+    print(f"SIBS worker listening on {server.server_address[0]}:{server.server_address[1]} ({jobs} jobs)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+def pingworker(addr: tuple[str, int], timeout: float = 2.0) -> int:
+    # returns how many jobs the worker takes, 0 if it isn't available
+    try:
+        with socket.create_connection(addr, timeout=timeout) as sock:
+            sendmsg(sock, {"op": "ping"})
+            header, _ = recvmsg(sock)
+            if header.get("ok"):
+                return int(header.get("jobs", 1))
+    except (OSError, ValueError):
+        pass
+    return 0
+
+class RemoteExecutor(Executor):
+    # sources are preprocessed locally and compiled by the workers
+    # anything that can't be sent (or a worker that stops answering) is compiled locally instead
+    def __init__(self, workers: list[str], jobs: int, showcommands: bool = False):
+        super().__init__(showcommands)
+        self.slots = queue.Queue()
+        for _ in range(jobs):
+            self.slots.put(None)
+        remote = 0
+        for w in workers:
+            addr = parseaddr(w)
+            n = pingworker(addr)
+            if n == 0:
+                print(f"Warning: worker '{w}' is not available, not using it")
+                continue
+            for _ in range(n):
+                self.slots.put(addr)
+            remote += n
+        if remote == 0:
+            print("Warning: no workers available, compiling locally")
+        self.pool = ThreadPoolExecutor(max_workers=jobs+remote)
+
+    def runall(self, steps: list) -> list[bool]:
+        return list(self.pool.map(self.tracked, steps))
+
+    def runstep(self, step) -> bool:
+        slot = self.slots.get()
+        try:
+            if slot != None:
+                ok = self.runremote(step, slot)
+                if ok != None:
+                    return ok
+            return runsteplocal(step, self.showcommands, self.progress)
+        finally:
+            self.slots.put(slot)
+
+    def runremote(self, step, addr: tuple[str, int]) -> bool:
+        # returns None if the step has to be compiled locally
+        templates = step.templates()
+        if len(templates) != 1 or " -c " not in templates[0]:
+            return None
+        template = templates[0]
+        language = "c" if step.src.endswith(".c") else "c++"
+        request = workerrequest(template, language)
+        if request == None:
+            return None
+        suffix = workerlanguages[language]
+        with tempfile.TemporaryDirectory(prefix="sibspre") as tmp:
+            pre = os.path.join(tmp, "pre"+suffix)
+            precmd = template.replace(" -c ", " -E ").replace("$SRC", step.src).replace("$OUT", pre)
+            a = subprocess.run(precmd, shell=True, capture_output=True, cwd=step.cwd)
+            if a.returncode != 0:
+                return None # let the local compile report the error
+            with open(pre, "rb") as f:
+                payload = f.read()
+        try:
+            with socket.create_connection(addr) as sock:
+                sendmsg(sock, request, payload)
+                header, obj = recvmsg(sock)
+        except (OSError, ValueError) as e:
+            printout(f"Warning: worker {addr[0]}:{addr[1]} failed ({e}), compiling '{step.src}' locally", self.progress)
+            return None
+        if not header.get("ok"):
+            printout(f"Warning: worker {addr[0]}:{addr[1]} refused '{step.src}' ({header.get('error')}), compiling locally", self.progress)
+            return None
+        out = ""
+        if self.showcommands:
+            out += f"[{addr[0]}:{addr[1]}] "+template.replace("$SRC", step.src).replace("$OUT", step.out)+"\n"
+        printout(out+header["stdout"]+header["stderr"], self.progress)
+        if header["returncode"] != 0:
+            return False
+        # step.out is relative to the step's directory, like the commands
+        out = os.path.join(step.cwd, step.out)
+        with open(out+".sibstmp", "wb") as f:
+            f.write(obj)
+        os.replace(out+".sibstmp", out)
+        return True
+
+    def close(self):
+        self.pool.shutdown()
+
+def makeexecutor(jobs: int, workers: list[str], showcommands: bool = False, progress: Progress = None) -> Executor:
+    if len(workers) > 0:
+        executor = RemoteExecutor(workers, jobs, showcommands)
+    elif jobs > 1:
+        executor = PoolExecutor(jobs, showcommands)
+    else:
+        executor = Executor(showcommands)
+    executor.progress = progress
+    return executor
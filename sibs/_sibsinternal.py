@@ -3,10 +3,18 @@ import distutils.ccompiler
 import os
 import hashlib
 import shutil
-import pickle
+import mmap
+import json
+import re
+import shlex
+import struct
 import subprocess
 import sys
+import threading
+import copy
+from contextlib import contextmanager
 from ._version import *
+from ._sibsexec import *
 import glob
 
 # OPTIONS, these can be set by the cmdline
@@ -20,6 +28,18 @@ sibsopt_cxxlflags = ""
 sibsopt_cclflags = ""
 sibsopt_arflags = ""
 sibsopt_showcommands = False
+sibsopt_config = ""
+sibsopt_jobs = 1
+sibsopt_dryrun = False
+sibsopt_explain = False
+sibsopt_cachegc = False
+sibsopt_cc = ""
+sibsopt_cxx = ""
+sibsopt_ar = ""
+sibsopt_ld = ""
+sibsopt_workers = []
+sibsopt_targets = []
+sibsopt_prefixmap = True
 # sibsopt_nobuild = False
 # sibsopt_nocopy = False
 # sibsopt_nolink = False
@@ -82,6 +102,9 @@ class BuildUnit:
     dolink: bool = False
     docompile: bool = False
     changed: bool = True
+    compilehash: str = "" # hash of the compile commands, so different flags get different objects
+    statedigest: bytes = b"" # hash of the digests of its sources and sibs.txt (or its cmake directory) in this build
+    reasons: list[str] = field(default_factory=lambda: []) # why changed is set, for --explain
     cmakebuilddir: str = ""
     cmaketarget: str = ""
     prefix: str = ""
@@ -113,40 +136,285 @@ class CmakeUnitLoad:
             self.out_type = "UNKNOWN"
 
 
+# the project root (the directory of the top sibs.txt), set by the Project that is loading
+# paths in cache keys and commands are relative to it, so a project can be moved or cloned elsewhere
+# sibs never changes the current directory, paths are joined with the root (or the sibs.txt's directory) instead
 firstpath = os.getcwd()
 
+def rootpath(path: str, here: str = None) -> str:
+    # path (relative to here, the project root by default) relative to the project root, if it is inside it
+    full = os.path.normpath(os.path.join(here if here != None else firstpath, path))
+    rel = os.path.relpath(full, firstpath)
+    if rel == ".." or rel.startswith(".."+os.sep):
+        return full
+    return os.path.normpath(rel)
+
+def builddir(here: str) -> str:
+    # what $BUILDDIR is replaced with, relative to here (the directory of the sibs.txt)
+    return os.path.relpath(os.path.join(firstpath, "build"), here)
+
+# flags added by the named configurations, any other name is just its own namespace
+configpresets = {
+    "debug": "-g",
+    "release": "-O2 -DNDEBUG",
+}
+
+def configdir(config: str) -> str:
+    # every configuration gets its own objects, outputs and hash cache, relative to the project root
+    if config == "":
+        return "build"
+    # under their own directory, so a configuration can't be named like a unit output or obj and cmake
+    return "build/config/"+config
+
+def outdir() -> str:
+    return configdir(sibsopt_config)
+
+# --toolchain= presets, (cc, cxx, ar, ld)
+toolchainpresets = {
+    "gcc": ("gcc", "g++", "ar", ""),
+    "clang": ("clang", "clang++", "ar", ""),
+    "llvm": ("clang", "clang++", "llvm-ar", "lld"),
+}
+
+@dataclass
+class Toolchain:
+    cc: str = "gcc"
+    cxx: str = "g++"
+    ar: str = "ar"
+    ld: str = "" # linker for the compiler driver to use (lld, mold, gold, or a path), empty for its default
+    probed: dict = field(default_factory=lambda: {})
+
+    def ldname(self) -> str:
+        # the -fuse-ld= name of the linker, ld.gold and x86_64-linux-gnu-ld.gold are gold, a target prefixed ld is bfd
+        name = os.path.basename(self.ld)
+        if name == "ld" or name == "":
+            return ""
+        if name.endswith("-ld"):
+            return "bfd"
+        if "ld." in name:
+            name = name[name.rfind("ld.")+len("ld."):]
+        elif name.endswith(".lld"): # ld64.lld, wasm-ld is left as a path
+            name = "lld"
+        if name in ["lld", "mold", "gold", "bfd"]:
+            return name
+        return None
+
+    def ldflag(self, compiler: str) -> str:
+        name = self.ldname()
+        if name == "":
+            return ""
+        if name != None:
+            return f" -fuse-ld={name}"
+        # only clang takes a path to any linker, gcc is left with its own
+        if "clang" in os.path.basename(compiler.split()[0]):
+            return f" --ld-path={self.ld}"
+        return ""
+
+    def identity(self, linking: bool = True) -> str:
+        # what the tools are, not just what they are called, so upgrading one invalidates what it built
+        # the archiver and linker don't affect objects, so switching linkers doesn't recompile
+        tools = [self.cc, self.cxx]
+        if linking:
+            tools += [self.ar, self.ld]
+        return "\n".join([f"{tool}={probetool(self, tool, tool in [self.cc, self.cxx])}" for tool in tools if tool != ""])
+
+toolchain = Toolchain()
+
+def toolpath(tool: str) -> str:
+    path = shutil.which(tool)
+    if path == None and "/" not in tool:
+        # lld and mold are installed as ld.lld and ld.mold
+        path = shutil.which("ld."+tool)
+    return path
+
+def probetool(tc: Toolchain, tool: str, compiler: bool = False) -> str:
+    # runs '<tool> --version' (and '<tool> -dumpmachine' for compilers) once per tool binary,
+    # the results are kept in build/toolchain.json and reused as long as the binary has the same path, size and mtime
+    # only the results are returned, so the same compiler installed somewhere else builds the same objects
+    if tool in tc.probed:
+        return tc.probed[tool]
+    path = toolpath(tool.split()[0])
+    if path == None:
+        print(f"Warning: '{tool}' not found")
+        tc.probed[tool] = "notfound"
+        return tc.probed[tool]
+    st = os.stat(path)
+    key = f"{tool}:{os.path.realpath(path)}:{st.st_size}:{st.st_mtime_ns}"
+    cachefile = os.path.join(firstpath, "build", "toolchain.json")
+    probes = {}
+    if os.path.exists(cachefile):
+        with open(cachefile, "r") as f:
+            try:
+                probes = json.load(f)
+            except ValueError:
+                probes = {}
+    if not isinstance(probes.get(key), dict) or (compiler and "machine" not in probes[key]):
+        a = subprocess.run([path, "--version"], capture_output=True)
+        lines = (a.stdout.decode()+a.stderr.decode()).strip().split("\n")
+        probes[key] = {"version": lines[0].strip()}
+        if compiler:
+            a = subprocess.run([path, "-dumpmachine"], capture_output=True)
+            probes[key]["machine"] = a.stdout.decode().strip() if a.returncode == 0 else ""
+        if not sibsopt_dryrun:
+            os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+            with open(cachefile, "w") as f:
+                json.dump(probes, f, indent=4)
+    tc.probed[tool] = probes[key]["version"]
+    if compiler:
+        tc.probed[tool] += " ("+probes[key]["machine"]+")"
+    return tc.probed[tool]
+
+def picktoolchain() -> Toolchain:
+    # options win over the CC/CXX/AR/LD environment variables, which win over the defaults
+    tc = Toolchain()
+    tc.cc = sibsopt_cc or os.environ.get("CC", "") or tc.cc
+    tc.cxx = sibsopt_cxx or os.environ.get("CXX", "") or tc.cxx
+    tc.ar = sibsopt_ar or os.environ.get("AR", "") or tc.ar
+    tc.ld = sibsopt_ld or os.environ.get("LD", "") or tc.ld
+    if tc.ldname() == None and ("clang" not in os.path.basename(tc.cxx.split()[0]) or "clang" not in os.path.basename(tc.cc.split()[0])):
+        print(f"Warning: linker '{tc.ld}' can only be passed to clang, gcc links with its own")
+    return tc
+
 class HashCache:
-    # key pair file that stores hashes as bytes
-    def __init__(self):
-        self.hcache = {}
-        # we will load and store the bytes ourselves
-    
-    def write(self):
-        if not os.path.exists(os.path.join(firstpath, "build")):
-            os.makedirs(os.path.join(firstpath, "build"))
-        
-        with open(os.path.join(firstpath, "build/sibs.hcache"), "wb+") as f:
-            pickle.dump(self.hcache, f)
+    # build/sibs.hcache is a 16 byte header and a table of fixed width records sorted by key
+    # every record is the sha256 of the key followed by the 32 byte hash stored for it
+    # the table is mmaped and binary searched, so nothing is deserialized when it is read
+    # changes are kept in memory until write() merges them into a new table
+    magic = b"SIBSHC"
+    version = 1
+    headerfmt = "!6sHI4x"
+    headersize = struct.calcsize(headerfmt)
+    recsize = 64
+
+    def __init__(self, path: str):
+        self.file_path = path
+        self.pending = {} # key digest -> value, None if the key was deleted
+        self.used = set() # key digests looked at during this build, everything else is garbage
+        self.readonly = False # set for dry runs, nothing is stored (not even in memory)
+        self.loaded = False # set by read(), write() never replaces a file that was not read
+        self.file = None
+        self.mm = None
+        self.count = 0
+
+    def path(self) -> str:
+        return self.file_path
+
+    def close(self):
+        if self.mm != None:
+            self.mm.close()
+            self.mm = None
+        if self.file != None:
+            self.file.close()
+            self.file = None
+        self.count = 0
 
-    
     def read(self):
-        if os.path.exists(os.path.join(firstpath, "build/sibs.hcache")):
-            with open(os.path.join(firstpath, "build/sibs.hcache"), "rb") as f:
-                self.hcache = pickle.load(f)
+        self.close()
+        self.loaded = True
+        if not os.path.exists(self.path()):
+            return
+        f = open(self.path(), "rb")
+        size = os.fstat(f.fileno()).st_size
+        header = f.read(self.headersize)
+        if len(header) != self.headersize or header[:len(self.magic)] != self.magic:
+            # this includes the old pickled caches, which we don't load (they aren't safe to unpickle)
+            print("Ignoring hash cache in an unknown format, everything will be rebuilt")
+            f.close()
+            return
+        magic, version, count = struct.unpack(self.headerfmt, header)
+        if version != self.version or size != self.headersize+count*self.recsize:
+            print(f"Ignoring hash cache (version {version}, expected {self.version}), everything will be rebuilt")
+            f.close()
+            return
+        self.file = f
+        self.count = count
+        if count > 0:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def records(self):
+        for i in range(self.count):
+            off = self.headersize+i*self.recsize
+            yield (self.mm[off:off+32], self.mm[off+32:off+64])
+
+    def lookup(self, kd: bytes) -> bytes:
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo+hi)//2
+            off = self.headersize+mid*self.recsize
+            k = self.mm[off:off+32]
+            if k == kd:
+                return self.mm[off+32:off+64]
+            if k < kd:
+                lo = mid+1
+            else:
+                hi = mid
+        return None
+
+    def write(self, gc: bool = False) -> tuple[int, int]:
+        # returns how many entries were kept and how many there were before
+        if self.readonly or (len(self.pending) == 0 and not gc):
+            return (self.count, self.count)
+        if not self.loaded and os.path.exists(self.path()):
+            # e.g. with --nohcache, writing would replace every entry in it with the few from this build
+            return (self.count, self.count)
+        table = dict(self.records())
+        before = len(table)
+        for kd, value in self.pending.items():
+            if value == None:
+                table.pop(kd, None)
+            else:
+                table[kd] = value
+        if gc:
+            table = {kd: value for kd, value in table.items() if kd in self.used}
+        os.makedirs(os.path.dirname(self.path()), exist_ok=True)
+        tmp = self.path()+".tmp"
+        with open(tmp, "wb") as f:
+            f.write(struct.pack(self.headerfmt, self.magic, self.version, len(table)))
+            for kd in sorted(table):
+                f.write(kd+table[kd])
+        self.close()
+        os.replace(tmp, self.path())
+        self.pending = {}
+        self.read()
+        return (len(table), before)
 
     def setbytes(self, key: str, value: bytes):
-        self.hcache[key] = value
-        self.write()
+        if self.readonly:
+            return
+        if len(value) != 32:
+            raise ValueError("hash cache values have to be 32 bytes")
+        kd = hashlib.sha256(key.encode()).digest()
+        self.used.add(kd)
+        self.pending[kd] = value
 
     def sethash(self, file: str):
         with open(file, "rb") as f:
             self.setbytes(file, hashlib.sha256(f.read()).digest())
     
     def gethash(self, file: str) -> bytes:
-        if file in self.hcache:
-            return self.hcache[file]
-        else:
-            return None
+        kd = hashlib.sha256(file.encode()).digest()
+        self.used.add(kd)
+        if kd in self.pending:
+            return self.pending[kd]
+        return self.lookup(kd)
+
+    def haskey(self, key: str) -> bool:
+        return self.gethash(key) != None
+
+    def delkey(self, key: str):
+        if self.readonly:
+            return
+        self.pending[hashlib.sha256(key.encode()).digest()] = None
+
+    def touch(self, key: str):
+        # keeps an entry alive through --cache-gc without looking it up
+        self.used.add(hashlib.sha256(key.encode()).digest())
+
+def markchanged(unit: BuildUnit, reason: str):
+    unit.changed = True
+    if reason not in unit.reasons:
+        unit.reasons.append(reason)
 
 def strhash(x):
     return hashlib.sha256(x.encode()).hexdigest()
@@ -173,9 +441,24 @@ def hashdir(path: str) -> bytes:
     return out
     
 
-if not sibsopt_nohcache:
-    hashcache = HashCache()
-    hashcache.read()
+# the hash cache of the Project that is loading, set by Project.active
+hashcache = HashCache(os.path.join("build", "sibs.hcache"))
+
+# the cmake configures of a Project, so building it again doesn't run cmake again, None from the command line
+# (cmake directory, prefix, name) -> (hash of the directory, units)
+cmakeconfigs = None
+
+def finddep(units: list[BuildUnit], dep: str) -> BuildUnit:
+    for un in units:
+        if dep == un.name:
+            return un
+        if dep == un.directory:
+            return un
+        if un.prefix + dep == un.name:
+            return un
+        if dep.endswith(un.name) and un.prefix in dep:
+            return un
+    return None
 
 def getdirectdeps(units: list[BuildUnit], unit: BuildUnit) -> list[BuildUnit]:
     deps = []
@@ -185,20 +468,7 @@ def getdirectdeps(units: list[BuildUnit], unit: BuildUnit) -> list[BuildUnit]:
         dep = dep.strip()
         if dep == "":
             continue
-        dp = None
-        for un in units:
-            if dep == un.name:
-                dp = un
-                break
-            if dep == un.directory:
-                dp = un
-                break
-            if un.prefix + dep == un.name:
-                dp = un
-                break
-            if dep.endswith(un.name) and un.prefix in dep:
-                dp = un
-                break
+        dp = finddep(units, dep)
         
         if dp == None:
             print(f"Dependency '{dep}' not found!")
@@ -213,37 +483,23 @@ def getdirectdeps(units: list[BuildUnit], unit: BuildUnit) -> list[BuildUnit]:
 
 def getdeps(units: list[BuildUnit], unit: BuildUnit) -> list[BuildUnit]:
     deps = []
-    if 'DEPS' not in unit.dat:
-        return []
-    for dep in unit.dat['DEPS'].split('\n'):
-        dep = dep.strip()
-        if dep == "":
-            continue
-        dp = None
-        for un in units:
-            if dep == un.name:
-                dp = un
-                break
-            if dep == un.directory:
-                dp = un
-                break
-            if un.prefix + dep == un.name:
-                dp = un
-                break
-            if dep.endswith(un.name) and un.prefix in dep:
-                dp = un
-                break
-        if dp == None:
-            print(f"Dependency '{dep}' not found!")
-            print("Available dependencies:")
-            for un in units:
-                print(f"    {un.name}")
-            exit(1)
+    for dp in getdirectdeps(units, unit):
         deps.append(dp)
         if 'DEPS' in dp.dat:
             deps += getdeps(units, dp)
     return deps
 
+def gendeps(units: list[BuildUnit], unit: BuildUnit) -> list[BuildUnit]:
+    # the generators this unit depends on directly, dependencies that aren't loaded yet are left for later
+    deps = []
+    if 'DEPS' not in unit.dat:
+        return []
+    for dep in unit.dat['DEPS'].split('\n'):
+        dp = finddep(units, dep.strip())
+        if dep.strip() != "" and dp != None and dp.out_type == 'GEN':
+            deps.append(dp)
+    return deps
+
 def getused(units: list[BuildUnit], unit_name: str) -> list[BuildUnit]:
     # get all units that use this one
     used = []
@@ -257,18 +513,347 @@ def getused(units: list[BuildUnit], unit_name: str) -> list[BuildUnit]:
 
 
 
+# generated files with these extensions are compiled into the units that depend on the generator, the rest (headers, data) aren't
+compiledexts = [".c", ".cc", ".cpp", ".cxx", ".C"]
+
+def objhash(unit: BuildUnit, src: str) -> str:
+    # names both the object and the source's entry in the hash cache
+    # the compile commands are part of it, so switching flags back and forth reuses objects
+    if unit.compilehash == "":
+        return strhash(unit.name+":"+src)
+    return strhash(unit.name+":"+src+":"+unit.compilehash)
+
 def filedigest(path: str) -> bytes:
     return hashlib.sha256(open(path, "rb").read()).digest()
 
-def loadunits(path: str, prefix: str = "") -> tuple[list[BuildUnit], list[str]]:
-    # go into path
+@dataclass
+class GenStep:
+    # a BUILDCMDS/CONFCMDS line with declared inputs and outputs, it only runs when they change
+    # the command runs in the directory of its sibs.txt, inputs and outputs are relative to it
+    command: str
+    cwd: str
+    inputs: list[str]
+    outputs: list[str]
+    key: str # the command's entry in the hash cache
+    root: str # the project root
+    line: str # the command passed through compilecmd
+    willrun: bool = False
+    reasons: list[str] = field(default_factory=lambda: [])
+    unit: BuildUnit = None # only if it is named, so units can depend on it
+
+    def produces(self) -> list[str]:
+        # outputs relative to the project root, like sources in compile steps
+        return [os.path.normpath(os.path.relpath(os.path.join(self.cwd, out), self.root)) for out in self.outputs]
+
+    def templates(self) -> list[str]:
+        # never sent to workers
+        return []
+
+    def cmdlines(self) -> list[str]:
+        return [self.line]
+
+    def label(self) -> str:
+        return self.command
+
+def parsedeclared(line: str) -> tuple[str, list[str], list[str], str]:
+    # GEN(name) IN(inputs...) OUT(outputs...) command
+    # every part but the command is optional, inputs and outputs are None for plain commands
+    name = ""
+    inputs = None
+    outputs = None
+    while True:
+        part = None
+        for kw in ["GEN(", "IN(", "OUT("]:
+            if line.startswith(kw):
+                part = kw
+        if part == None:
+            break
+        en = line.find(')')
+        if en == -1:
+            print(f"No ')' after {part[:-1]} in '{line}'")
+            exit(1)
+        val = line[len(part):en].strip()
+        line = line[en+1:].strip()
+        if part == "GEN(":
+            name = val
+        elif part == "IN(":
+            inputs = val.split()
+        else:
+            outputs = val.split()
+    if name != "" and outputs == None:
+        print(f"Generator '{name}' has no OUT(...)")
+        exit(1)
+    if inputs != None and outputs == None:
+        outputs = []
+    if outputs != None and inputs == None:
+        inputs = []
+    return (name, inputs, outputs, line)
+
+def gensignature(step: GenStep) -> bytes:
+    h = hashlib.sha256()
+    h.update(step.command.encode()+b"\n")
+    for inp in step.inputs:
+        path = os.path.join(step.cwd, inp)
+        if not os.path.exists(path):
+            return None
+        h.update(inp.encode()+b"\0"+filedigest(path))
+    return h.digest()
+
+def makegenstep(command: str, inputs: list[str], outputs: list[str], here: str) -> GenStep:
+    # here is the directory of the sibs.txt, the command runs in it
+    bdir = builddir(here)
+    ins = []
+    for inp in inputs:
+        inp = inp.replace("$BUILDDIR", bdir)
+        if inp.find("*") != -1:
+            ins += sorted(glob.glob(inp, recursive=True, root_dir=here))
+        else:
+            ins.append(inp)
+    outs = [out.replace("$BUILDDIR", bdir) for out in outputs]
+    command = command.replace("$BUILDDIR", bdir).replace("$IN", ' '.join(ins)).replace("$OUT", ' '.join(outs))
+    step = GenStep(command, here, ins, outs, "gen:"+os.path.normpath(os.path.relpath(here, firstpath))+":"+command, firstpath, compilecmd(command))
+    sig = gensignature(step)
+    if sibsopt_nohcache:
+        step.reasons.append("--nohcache")
+    elif sig == None:
+        step.reasons.append("an input is missing")
+    elif hashcache.gethash(step.key) == None:
+        step.reasons.append("command is new")
+    elif hashcache.gethash(step.key) != sig:
+        step.reasons.append("inputs or command changed")
+    for out in outs:
+        if not os.path.exists(os.path.join(here, out)):
+            step.reasons.append(f"output '{out}' missing")
+    step.willrun = len(step.reasons) > 0
+    return step
+
+def gendone(step: GenStep, hc: HashCache, nohcache: bool):
+    # signed after it ran, an input may have been generated by another command in the same build
+    if nohcache:
+        return
+    sig = gensignature(step)
+    if sig != None:
+        hc.setbytes(step.key, sig)
+
+def ordergens(gens: list[GenStep]) -> dict[int, int]:
+    # a generator runs after the generators that produce its inputs (and reruns with them)
+    # returns the wave of every generator by id
+    producers = {}
+    for g in gens:
+        for out in g.produces():
+            producers[out] = g
+    levels = {}
+    def levelof(g: GenStep, path: list[int]) -> int:
+        if id(g) in levels:
+            return levels[id(g)]
+        if id(g) in path:
+            print(f"Error: generated files depend on each other in a cycle ('{g.command}')")
+            exit(1)
+        lvl = 0
+        for inp in g.inputs:
+            inp = os.path.normpath(os.path.relpath(os.path.join(g.cwd, inp), firstpath))
+            if inp in producers and producers[inp] is not g:
+                pg = producers[inp]
+                lvl = max(lvl, levelof(pg, path+[id(g)])+1)
+                if pg.willrun and not g.willrun:
+                    g.willrun = True
+                    g.reasons.append(f"input '{inp}' is generated by a command that will run")
+        levels[id(g)] = lvl
+        if g.willrun and g.unit != None:
+            for reason in g.reasons:
+                markchanged(g.unit, reason)
+        return lvl
+    for g in gens:
+        levelof(g, [])
+    return levels
+
+def batchwaves(units: list[BuildUnit], batch: list, genlevels: dict[int, int]) -> list[list]:
+    # splits generators and compiles into waves that can each run in parallel
+    # a compile waits for the generators its unit depends on and the one producing its source
+    gens = [step for step in batch if isinstance(step, GenStep)]
+    produced = {}
+    for g in gens:
+        for out in g.produces():
+            produced[out] = g
+    waves = {}
+    for step in batch:
+        if isinstance(step, GenStep):
+            lvl = genlevels.get(id(step), 0)
+        else:
+            lvl = 0
+            deps = [dep for dep in getdeps(units, step.unit) if dep.out_type == 'GEN']
+            for g in gens:
+                if g.unit in deps or produced.get(os.path.normpath(step.src)) is g:
+                    lvl = max(lvl, genlevels.get(id(g), 0)+1)
+        waves.setdefault(lvl, []).append(step)
+    return [waves[lvl] for lvl in sorted(waves)]
+
+def loadcmake(p: str, prefix: str, cmakename: str, here: str) -> list[BuildUnit]:
+    # imports the targets of the cmake project p (relative to here) as units named prefix+cmakename_target
+    p = os.path.normpath(os.path.join(here, p.replace("$BUILDDIR", builddir(here))))
+    if cmakeconfigs == None:
+        return configurecmake(p, prefix, cmakename)
+    key = (p, prefix, cmakename)
+    hashd = hashdir(p)
+    if key in cmakeconfigs and cmakeconfigs[key][0] == hashd:
+        print(f"CMAKE {rootpath(p)} (unchanged, not configured again)")
+    else:
+        cmakeconfigs[key] = (hashd, configurecmake(p, prefix, cmakename))
+    # loading changes the units, the kept ones stay as cmake made them
+    return copy.deepcopy(cmakeconfigs[key][1])
+
+def configurecmake(p: str, prefix: str, cmakename: str) -> list[BuildUnit]:
+    # p is absolute
+    units = []
+    cmakebuild = os.path.join(p, ".sibscmakebuild")
+    cmakelog = os.path.join(firstpath, "build/cmake/cmake"+rootpath(p).replace("/", "_").replace("\\", "_").replace(":", "_")+".log")
+    # cmake build directories can't be moved, one from before the project was moved or copied is started over
+    cmakecache = os.path.join(cmakebuild, "CMakeCache.txt")
+    moved = False
+    if os.path.exists(cmakecache):
+        with open(cmakecache, "r") as f:
+            for ln in f.readlines():
+                if ln.startswith("CMAKE_CACHEFILE_DIR:INTERNAL="):
+                    moved = os.path.realpath(ln.strip()[len("CMAKE_CACHEFILE_DIR:INTERNAL="):]) != os.path.realpath(cmakebuild)
+                    break
+    if sibsopt_dryrun and not moved and os.path.exists(cmakecache) and os.path.exists(cmakelog):
+        # a dry run doesn't touch the CMakeLists.txt or run cmake, the output of the last configure has the targets
+        print(f"CMAKE {rootpath(p)} (dry run, using its last configure)")
+        with open(cmakelog, "r") as f:
+            output = f.read()
+    else:
+        print(f"CMAKE {rootpath(p)}")
+        # we add the cmake loader to the end of the p CMakeLists.txt
+        # then run cmake on it, and then remove the loader
+        with open(p+"/CMakeLists.txt", "r") as f:
+            cmakelines = f.readlines()
+        with open(p+"/CMakeLists.txt", "w") as f:
+            for ln in cmakelines:
+                f.write(ln)
+            f.write('\n# SIBSLOADER_START\n')
+            f.write(cmakeloader)
+            f.write('\n# SIBSLOADER_END\n')
+        if moved:
+            print(f"Reconfiguring {rootpath(p)} (its cmake build directory was made somewhere else)")
+            shutil.rmtree(cmakebuild)
+        os.makedirs(cmakebuild, exist_ok=True)
+        os.makedirs(os.path.join(firstpath, "build/cmake/"), exist_ok=True)
+        # os.system(f"cmake -B {builddir} {p} > "+os.path.join(firstpath, "build/cmake/cmake.log"))
+        # use subprocess to capture the output
+        a = subprocess.run(["cmake", "-B", cmakebuild, p], capture_output=True)
+        with open(cmakelog, "w") as f:
+            f.write(a.stdout.decode())
+        with open(p+"/CMakeLists.txt", "w") as f:
+            for ln in cmakelines:
+                f.write(ln)
+        if a.returncode != 0:
+            print(f"Error: cmake failed for {rootpath(p)}:")
+            print(a.stderr.decode())
+            exit(1)
+        output = a.stdout.decode()
+
+    cmakelines = output.split('\n')
+    sibsunits = []
+    for lnus in cmakelines:
+        ln = lnus.strip()
+        if "_SIBSUNIT_" in ln:
+            st = ln.find("_SIBSUNIT_")
+            en = ln.find("_SIBSEND_")
+            sibsunits.append(ln[st+len("_SIBSUNIT_"):en])
+    # now we need to load these units into actual BuildUnits
+
+    for su in sibsunits:
+        su = su.strip()
+        if su == "":
+            continue
+        cu = CmakeUnitLoad(su, p)
+        # now we need to convert this to a BuildUnit
+        if cu.out_type == "UNKNOWN":
+            continue
+
+        bu = BuildUnit(prefix+cmakename+"_"+cu.name, cu.out_type, {})
+        bu.dat['DEPS'] = ""
+        bu.skip = True
+        # some includes will have special things in them:
+        # $<BUILD_INTERFACE:...> replaces with ...
+        # $<INSTALL_INTERFACE:...> replaces with ...
+        # these are converted to absolite IF they aren't already
+        # relative to the cmake directory
+        incstr = ""
+        for incn in cu.inc.split(';'):
+            inc = incn.strip()
+            if inc.startswith("$<BUILD_INTERFACE:"):
+                inc = inc[len("$<BUILD_INTERFACE:"):-1]
+            if inc.startswith("$<INSTALL_INTERFACE:"):
+                inc = inc[len("$<INSTALL_INTERFACE:"):-1]
+            if not os.path.isabs(inc):
+                inc = os.path.join(p, inc)
+            incstr += f" -I {rootpath(inc)}"
+
+        bu.incstr = incstr
+        out = rootpath(cu.out)
+        if cu.out_type == "STATIC":
+            bu.static.append(out)
+        elif cu.out_type == "DYN":
+            bu.dynamic.append(out)
+        bu.thisoutput = out
+        # commands.append("cmake --build "+builddir+" --target "+cu.name)
+        bu.cmakebuilddir = rootpath(cmakebuild)
+        bu.cmaketarget = cu.name
+
+        bu.directory = p
+        bu.prefix = prefix
+        units.append(bu)
+    return units
+
+def importneeded(prefix: str, name: str, dirs: list[str], names: set[str]) -> set[str]:
+    # the names an import (SIBS or CMAKE block) could provide, its units are all called prefix+name_...
+    return {n for n in names if n.startswith(prefix+name+"_") or n.startswith(name+"_") or n in dirs}
+
+def targetclosure(units: list[BuildUnit], wanted: set[str], prefix: str) -> tuple[list[BuildUnit], set[str]]:
+    # the units named in wanted and everything they depend on, and the names that aren't loaded (yet)
+    needed = []
+    missing = set()
+    todo = list(wanted)
+    seen = set()
+    while len(todo) > 0:
+        n = todo.pop().strip()
+        if n == "" or n in seen:
+            continue
+        seen.add(n)
+        found = finddep(units, n)
+        if found == None:
+            found = finddep(units, prefix+n)
+        if found == None:
+            missing.add(n)
+            continue
+        if found not in needed:
+            needed.append(found)
+            if 'DEPS' in found.dat:
+                todo += found.dat['DEPS'].split('\n')
+    return (needed, missing)
+
+def assembleimports(units: list[BuildUnit], imports: list, loaded: dict) -> list[BuildUnit]:
+    # puts the units of the loaded imports where their blocks were in the file
+    out = []
+    last = 0
+    for i, (kind, name, dirs, pos) in enumerate(imports):
+        out += units[last:pos]
+        last = pos
+        if i in loaded:
+            out += loaded[i][0]
+    out += units[last:]
+    return out
+
+def loadunits(path: str, prefix: str = "", wanted: set[str] = None, base: str = None) -> tuple[list[BuildUnit], list[str]]:
+    # with wanted (unit names) only the units they need are configured and hashed, None means all of them
+    # path is relative to base (the directory of the sibs.txt importing it), the project root by default
     if prefix != "":
         prefix = prefix+"_"
-    originalpath = os.getcwd()
-    os.chdir(path)
+    here = os.path.normpath(os.path.join(base if base != None else firstpath, path))
 
     units: list[BuildUnit] = []
-    with open("sibs.txt", "r") as f:
+    with open(os.path.join(here, "sibs.txt"), "r") as f:
         inplines: list[str] = f.readlines()
 
     commands = []
@@ -286,6 +871,9 @@ def loadunits(path: str, prefix: str = "") -> tuple[list[BuildUnit], list[str]]:
     gitmode = False
     buildcmds = False
     confcmds = False
+    # SIBS and CMAKE blocks are loaded once the whole file is read, so blocks that none of the wanted units need
+    # can be skipped, (kind, name, dirs, position in units)
+    imports = []
     for lineus in inplines:
         line = lineus.strip()
         if line.startswith("#"):
@@ -302,7 +890,10 @@ def loadunits(path: str, prefix: str = "") -> tuple[list[BuildUnit], list[str]]:
         if line.startswith("BUILDCMDS") and level == 0:
             # BUILDCMDS {
             #     echo hi
+            #     GEN(protos) IN(foo.proto) OUT(gen/foo.pb.cc gen/foo.pb.h) protoc --cpp_out=gen $IN
             # }
+            # lines with IN(...)/OUT(...) only run when their inputs changed or an output is missing
+            # GEN(name) lets units depend on the command, they compile its outputs and include their directories
             level += 1
             buildcmds = True
             continue
@@ -312,7 +903,24 @@ def loadunits(path: str, prefix: str = "") -> tuple[list[BuildUnit], list[str]]:
                 buildcmds = False
                 continue
             else:
-                commands.append(line.strip())
+                genname, genin, genout, cmd = parsedeclared(line.strip())
+                if genout == None:
+                    commands.append(cmd)
+                    continue
+                step = makegenstep(cmd, genin, genout, here)
+                if genname != "":
+                    gu = BuildUnit(prefix+genname, 'GEN', {})
+                    gu.directory = os.path.relpath(here, firstpath)
+                    gu.prefix = prefix
+                    gu.changed = False
+                    gu.dat['OUTPUTS'] = "\n".join(step.produces())
+                    for d in dict.fromkeys(os.path.dirname(out) for out in step.produces()):
+                        gu.incstr += f" -I {d if d != '' else '.'}"
+                    for reason in step.reasons:
+                        markchanged(gu, reason)
+                    step.unit = gu
+                    units.append(gu)
+                commands.append(step)
                 continue
 
         if line.startswith("CONFCMDS") and level == 0:
@@ -328,7 +936,18 @@ def loadunits(path: str, prefix: str = "") -> tuple[list[BuildUnit], list[str]]:
                 confcmds = False
                 continue
             else:
-                os.system(line.strip()) 
+                # same IN(...)/OUT(...) syntax as BUILDCMDS, but they still run right away
+                genname, genin, genout, cmd = parsedeclared(line.strip())
+                if genout != None:
+                    step = makegenstep(cmd, genin, genout, here)
+                    if not step.willrun:
+                        continue
+                if sibsopt_dryrun:
+                    print(f"CONFCMDS (not run, dry run) {cmd}")
+                elif genout == None:
+                    subprocess.run(cmd, shell=True, cwd=here)
+                elif subprocess.run(step.line, shell=True, cwd=here).returncode == 0:
+                    gendone(step, hashcache, sibsopt_nohcache)
                 continue
 
 
@@ -353,89 +972,7 @@ def loadunits(path: str, prefix: str = "") -> tuple[list[BuildUnit], list[str]]:
             if line.endswith('}'):
                 cmakemode = False
                 level -= 1
-                for p in cmakeprojs:
-                    p = p.replace("$BUILDDIR", os.path.join(firstpath, "build"))
-                    print(f"CMAKE {p}")
-                    # we add the cmake loader to the end of the p CMakeLists.txt
-                    # then run cmake on it, and then remove the loader
-                    with open(p+"/CMakeLists.txt", "r") as f:
-                        cmakelines = f.readlines()
-                    with open(p+"/CMakeLists.txt", "w") as f:
-                        for ln in cmakelines:
-                            f.write(ln)
-                        f.write('\n# SIBSLOADER_START\n')
-                        f.write(cmakeloader)
-                        f.write('\n# SIBSLOADER_END\n')
-                    builddir = os.path.join(p, ".sibscmakebuild")
-                    os.makedirs(builddir, exist_ok=True)
-                    # os.makedirs(os.path.join(firstpath, "build/cmake/"), exist_ok=True)
-                    # os.system(f"cmake -B {builddir} {p} > "+os.path.join(firstpath, "build/cmake/cmake.log"))
-                    # use subprocess to capture the output
-                    a = subprocess.run(["cmake", "-B", builddir, p], capture_output=True)
-                    with open (os.path.join(firstpath, "build/cmake/cmake"+p.replace("/", "_").replace("\\", "_").replace(":", "_")+".log"), "w") as f:
-                        f.write(a.stdout.decode())
-                    if a.returncode != 0:
-                        print(f"Error: cmake failed for {p}:")
-                        print(a.stderr.decode())
-                        exit(1)
-
-                    with open(p+"/CMakeLists.txt", "w") as f:
-                        for ln in cmakelines:
-                            f.write(ln)
-
-                    cmakelines = a.stdout.decode().split('\n')
-                    sibsunits = []
-                    for lnus in cmakelines:
-                        ln = lnus.strip()
-                        if "_SIBSUNIT_" in ln:
-                            st = ln.find("_SIBSUNIT_")
-                            en = ln.find("_SIBSEND_")
-                            sibsunits.append(ln[st+len("_SIBSUNIT_"):en])
-                    # now we need to load these units into actual BuildUnits
-
-                    for su in sibsunits:
-                        su = su.strip()
-                        if su == "":
-                            continue
-                        cu = CmakeUnitLoad(su, p)
-                        # now we need to convert this to a BuildUnit
-                        if cu.out_type == "UNKNOWN":
-                            continue
-
-                        bu = BuildUnit(prefix+cmakename+"_"+cu.name, cu.out_type, {})
-                        bu.dat['DEPS'] = ""
-                        bu.skip = True
-                        # some includes will have special things in them:
-                        # $<BUILD_INTERFACE:...> replaces with ...
-                        # $<INSTALL_INTERFACE:...> replaces with ...
-                        # these are converted to absolite IF they aren't already
-                        # relative to the cmake directory
-                        incstr = ""
-                        for incn in cu.inc.split(';'):
-                            inc = incn.strip()
-                            if inc.startswith("$<BUILD_INTERFACE:"):
-                                inc = inc[len("$<BUILD_INTERFACE:"):-1]
-                            if inc.startswith("$<INSTALL_INTERFACE:"):
-                                inc = inc[len("$<INSTALL_INTERFACE:"):-1]
-                            if not os.path.isabs(inc):
-                                inc = os.path.join(os.getcwd(), p, inc)
-                            incstr += f" -I {inc}"
-
-                        bu.incstr = incstr
-                        if cu.out_type == "STATIC":
-                            bu.static.append(cu.out)
-                        elif cu.out_type == "DYN":
-                            bu.dynamic.append(cu.out)
-                        bu.thisoutput = cu.out
-                        # we need to make builddir relative to the original path
-                        builddir = os.path.abspath(builddir)
-                        # commands.append("cmake --build "+builddir+" --target "+cu.name)
-                        bu.cmakebuilddir = builddir
-                        bu.cmaketarget = cu.name
-
-                        bu.directory = os.path.abspath(p)
-                        bu.prefix = prefix
-                        units.append(bu)
+                imports.append(("CMAKE", cmakename, cmakeprojs, len(units)))
             else:
                 cmakeprojs.append(line.strip())
                 continue
@@ -457,12 +994,7 @@ def loadunits(path: str, prefix: str = "") -> tuple[list[BuildUnit], list[str]]:
             if line.endswith('}'):
                 sibsmode = False
                 level -= 1
-                for d in sibsdirs:
-                    # way simpler than cmake
-                    print(f"SIBS {d}")
-                    a,b = loadunits(d, prefix=prefix+sibsname)
-                    units += a
-                    commands += b
+                imports.append(("SIBS", sibsname, sibsdirs, len(units)))
             else:
                 sibsdirs.append(line.strip())
                 continue
@@ -487,7 +1019,8 @@ def loadunits(path: str, prefix: str = "") -> tuple[list[BuildUnit], list[str]]:
                 stp = line.strip().split()
                 url = stp[0]
                 directory = stp[1]
-                directory = directory.replace("$BUILDDIR", os.path.join(firstpath, "build"))
+                directory = directory.replace("$BUILDDIR", builddir(here))
+                gitdir = os.path.join(here, directory)
                 if len(stp) > 2:
                     tag = stp[2]
                 else:
@@ -495,30 +1028,33 @@ def loadunits(path: str, prefix: str = "") -> tuple[list[BuildUnit], list[str]]:
                 # git doesn't import any units, just clones the repo
                 # if it already exists and is correct, just git pull
                 print(f"GIT {directory}")
-                if os.path.exists(directory):
+                if sibsopt_dryrun:
+                    print(f"Not updating '{directory}' (dry run)")
+                    continue
+                if os.path.exists(gitdir):
                     # set origin to the url
-                    a = subprocess.run(["git", "remote", "set-url", "origin", url], cwd=directory, capture_output=True)
+                    a = subprocess.run(["git", "remote", "set-url", "origin", url], cwd=gitdir, capture_output=True)
                     if a.returncode != 0:
                         print(f"Error: git remote set-url failed for {directory}:")
                         print(a.stderr.decode())
                         exit(1)
-                    a = subprocess.run(["git", "fetch", "origin", tag], cwd=directory, capture_output=True)
+                    a = subprocess.run(["git", "fetch", "origin", tag], cwd=gitdir, capture_output=True)
                     if a.returncode != 0:
                         print(f"Error: git fetch failed for {directory}:")
                         print(a.stderr.decode())
                         exit(1)
-                    a = subprocess.run(["git", "reset", "--hard", tag], cwd=directory, capture_output=True)
+                    a = subprocess.run(["git", "reset", "--hard", tag], cwd=gitdir, capture_output=True)
                     if a.returncode != 0:
                         print(f"Error: git reset failed for {directory}:")
                         print(a.stderr.decode())
                         exit(1)
-                    # a = subprocess.run(["git", "clean", "-f", "-d"], cwd=directory, capture_output=True)
+                    # a = subprocess.run(["git", "clean", "-f", "-d"], cwd=gitdir, capture_output=True)
                     # if a.returncode != 0:
                     #     print(f"Error: git clean failed for {directory}:")
                     #     print(a.stderr.decode())
                     #     exit(1)
                 
-                    a = subprocess.run(["git", "pull", "origin", tag], cwd=directory, capture_output=True)
+                    a = subprocess.run(["git", "pull", "origin", tag], cwd=gitdir, capture_output=True)
                     if a.returncode != 0:
                         print(f"Error: git pull failed for {directory}:")
                         print(a.stderr.decode())
@@ -527,7 +1063,7 @@ def loadunits(path: str, prefix: str = "") -> tuple[list[BuildUnit], list[str]]:
                 else:
                     if tag == "HEAD":
                         tag = "master"
-                    a = subprocess.run(["git", "clone", url, directory, "--branch", tag], capture_output=True)
+                    a = subprocess.run(["git", "clone", url, directory, "--branch", tag], cwd=here, capture_output=True)
                     if a.returncode != 0:
                         print(f"Error: git clone failed for {directory}:")
                         print(a.stderr.decode())
@@ -553,7 +1089,7 @@ def loadunits(path: str, prefix: str = "") -> tuple[list[BuildUnit], list[str]]:
             level += 1
             currentunit = BuildUnit(prefix+name, ty, {})
             # relative to original path, not cwwd
-            currentunit.directory = os.path.relpath(os.getcwd(), firstpath)
+            currentunit.directory = os.path.relpath(here, firstpath)
             continue
 
         if currentunit != None and level == 1:
@@ -574,43 +1110,102 @@ def loadunits(path: str, prefix: str = "") -> tuple[list[BuildUnit], list[str]]:
             else:
                 data += line + "\n"
 
+    # load the imports, with targets this repeats until nothing more is needed from them
+    # an import that turns out to be needed for more units than it was loaded for is loaded again
+    loaded = {}
+    localunits = units
+    while True:
+        allunits = assembleimports(localunits, imports, loaded)
+        if wanted == None:
+            missing = None
+        else:
+            missing = targetclosure(allunits, wanted, prefix)[1]
+        more = False
+        for i, (kind, name, dirs, pos) in enumerate(imports):
+            if missing == None:
+                if i in loaded:
+                    continue
+                want = None
+            else:
+                want = importneeded(prefix, name, dirs, missing)
+                if len(want) == 0 or (i in loaded and want <= loaded[i][2]):
+                    continue
+                if i in loaded:
+                    want = want | loaded[i][2]
+            a = []
+            b = []
+            for d in dirs:
+                if kind == "CMAKE":
+                    a += loadcmake(d, prefix, name, here)
+                else:
+                    # way simpler than cmake
+                    print(f"SIBS {d}")
+                    da, db = loadunits(d, prefix=prefix+name, wanted=want, base=here)
+                    a += da
+                    b += db
+            loaded[i] = (a, b, want)
+            more = True
+            break
+        if not more:
+            break
+    units = assembleimports(localunits, imports, loaded)
+    importcmds = []
+    for i in range(len(imports)):
+        if i in loaded:
+            importcmds += loaded[i][1]
+    commands = importcmds+commands
+
     print(f"Configuring done ({len(units)} units), Optimizing...")
 
     toremove = []
-    if not os.path.exists(firstpath+"/build"):
+    if not os.path.exists(firstpath+"/build") and not sibsopt_dryrun:
         os.makedirs(firstpath+"/build")
     unusedlog = firstpath+"/build/unused.txt"
+    targeted = []
+    if wanted != None:
+        # units the targets don't need aren't hashed or built, just like unused cmake units
+        needed = targetclosure(units, wanted, prefix)[0]
+        for unit in units:
+            if unit not in needed and not sibsopt_dryrun:
+                with open(unusedlog, "a") as f:
+                    f.write(f"{unit.name}\n")
+        units = [unit for unit in units if unit in needed]
+        commands = [cmd for cmd in commands if not (isinstance(cmd, GenStep) and cmd.unit != None and cmd.unit not in needed)]
+        # a cmake unit that is a target itself is built even though nothing uses it
+        targeted = [unit for unit in units if any(finddep([unit], n) != None or finddep([unit], prefix+n) != None for n in wanted)]
     for unit in units:
         if unit.skip:
             # this is a cmake unit, we need to add the command
             # cmake units only need to be built if they are used
             used = getused(units, unit.name)
-            if len(used) == 0:
+            if len(used) == 0 and unit not in targeted:
                 toremove.append(unit)
-                with open(unusedlog, "a") as f:
-                    f.write(f"{unit.name}\n")
+                if not sibsopt_dryrun:
+                    with open(unusedlog, "a") as f:
+                        f.write(f"{unit.name}\n")
                 continue
             
             # hash all files in the cmake directory (excluting the files under .git and .sibscmakebuild)
             # if the hash changes, we need to recompile
             hashd = hashdir(unit.directory)
+            unit.statedigest = hashd
             unit.changed = False
             unit.directory = os.path.relpath(unit.directory, firstpath)
             unit.directory = os.path.normpath(unit.directory)
             if not sibsopt_nohcache and not sibsopt_nohashdir:
-                if unit.directory in hashcache.hcache:
+                if hashcache.haskey(unit.directory):
                     if hashd != hashcache.gethash(unit.directory):
-                        unit.changed = True
+                        markchanged(unit, f"cmake directory '{unit.directory}' changed")
                         hashcache.setbytes(unit.directory, hashd)
                 else:
                     hashcache.setbytes(unit.directory, hashd)
-                    unit.changed = True
+                    markchanged(unit, f"cmake directory '{unit.directory}' is new")
             else:
-                unit.changed = True
+                markchanged(unit, "--nohcache/--nohashdir")
             if not unit.changed:
                 # check if output exists
-                if not os.path.exists(unit.thisoutput):
-                    unit.changed = True
+                if not os.path.exists(os.path.join(firstpath, unit.thisoutput)):
+                    markchanged(unit, f"output '{unit.thisoutput}' missing")
             
             if not unit.changed:
                 print(f"Skipping cmake unit '{unit.name}' (no changes)")
@@ -623,20 +1218,29 @@ def loadunits(path: str, prefix: str = "") -> tuple[list[BuildUnit], list[str]]:
             # change sources that contain "**" or "*" to glob
             newsources = ""
             for source in unit.dat['SOURCES'].split('\n'):
-                source = source.strip().replace("$BUILDDIR", os.path.join(firstpath, "build"))
+                source = source.strip().replace("$BUILDDIR", builddir(here))
                 if source.strip() == "":
                     continue
                 if source.find("**") != -1 or source.find("*") != -1:
-                    newsources += "\n".join(glob.glob(source.strip(), recursive=True))+"\n"
+                    newsources += "\n".join(glob.glob(source.strip(), recursive=True, root_dir=here))+"\n"
                 else:
                     newsources += source.strip()+"\n"
             unit.dat['SOURCES'] = newsources
 
         # only if this is our unit, not imported from another
-        if unit.directory != os.path.relpath(os.getcwd(), firstpath):
+        if unit.directory != os.path.relpath(here, firstpath):
             continue
+        # the source outputs of generators this unit depends on are compiled as part of it
+        # they aren't hashed, a generator that will run already marks its users changed
+        generated = []
+        for gen in gendeps(units, unit):
+            for out in gen.dat['OUTPUTS'].split('\n'):
+                if os.path.splitext(out.strip())[1] in compiledexts:
+                    generated.append(os.path.relpath(os.path.join(firstpath, out), here))
+        if len(generated) > 0:
+            unit.dat['SOURCES'] = unit.dat.get('SOURCES', "")+"\n".join(generated)+"\n"
         if 'INCLUDE' in unit.dat:
-            unit.dat['INCLUDE'] = unit.dat['INCLUDE'].replace("$BUILDDIR", os.path.join(firstpath, "build"))
+            unit.dat['INCLUDE'] = unit.dat['INCLUDE'].replace("$BUILDDIR", builddir(here))
             includes = unit.dat['INCLUDE'].split('\n')
             for inc in includes:
                 if inc.strip() == "":
@@ -649,21 +1253,21 @@ def loadunits(path: str, prefix: str = "") -> tuple[list[BuildUnit], list[str]]:
             continue
         # create the outputs
         if unit.out_type == 'DYN':
-            out = "build/"+unit.name+dynprefix
+            out = outdir()+"/"+unit.name+dynprefix
             unit.dynamic.append(out)
             unit.thisoutput = out
             if 'LINK' not in unit.dat:
                 unit.dat['LINK'] = defaultdyn
             unit.dolink = True
         elif unit.out_type == 'STATIC':
-            out = "build/"+unit.name+staticprefix
+            out = outdir()+"/"+unit.name+staticprefix
             unit.static.append(out)
             unit.thisoutput = out
             if 'LINK' not in unit.dat:
                 unit.dat['LINK'] = defaultstatic
             unit.dolink = True
         elif unit.out_type == 'EXEC':
-            out = "build/"+unit.name+execprefix
+            out = outdir()+"/"+unit.name+execprefix
             unit.thisoutput = out
             if 'LINK' not in unit.dat:
                 unit.dat['LINK'] = defaultexec
@@ -673,25 +1277,31 @@ def loadunits(path: str, prefix: str = "") -> tuple[list[BuildUnit], list[str]]:
             unit.docompile = True
             if 'COMPILE' not in unit.dat:
                 unit.dat['COMPILE'] = defaultobj
+            # without the prefix map, it has the absolute project root in it
+            unit.compilehash = strhash(compilecmd(unit.dat['COMPILE'], prefixmap=False)+"\n"+toolchain.identity(linking=False))
             sources = unit.dat['SOURCES'].split('\n')
             unit.changed = False
+            state = hashlib.sha256()
             newsources = ""
             for source in sources:
                 if source.strip() == "":
                     continue
                 src = os.path.normpath(os.path.join(unit.directory, source.strip()))
-                srchash = strhash(unit.name+":"+src)
-                if not sibsopt_nohcache:
-                    if not unit.changed:
-                        if srchash not in hashcache.hcache:
-                            hashcache.setbytes(srchash, filedigest(source.strip()))
-                            unit.changed = True
-                        else:
-                            if hashcache.gethash(srchash) != filedigest(source.strip()):
-                                hashcache.setbytes(srchash, filedigest(source.strip()))
-                                unit.changed = True
+                srchash = objhash(unit, src)
+                if source.strip() in generated:
+                    pass
+                elif not sibsopt_nohcache:
+                    # every source is recorded, otherwise the ones after the first change look new next build
+                    digest = filedigest(os.path.join(here, source.strip()))
+                    state.update(src.encode()+b"\0"+digest)
+                    if hashcache.gethash(srchash) == None:
+                        hashcache.setbytes(srchash, digest)
+                        markchanged(unit, f"source '{src}' is new")
+                    elif hashcache.gethash(srchash) != digest:
+                        hashcache.setbytes(srchash, digest)
+                        markchanged(unit, f"source '{src}' changed")
                 else:
-                    unit.changed = True
+                    markchanged(unit, "--nohcache")
                 if source.strip().endswith(".h") or source.strip().endswith(".hpp"):
                     continue
                 newsources += source.strip()+"\n"
@@ -700,38 +1310,82 @@ def loadunits(path: str, prefix: str = "") -> tuple[list[BuildUnit], list[str]]:
                 # also make it so that it is always the exact same string for the same source ex:
                 # "src/main.c" and "src\\main.c" are the same, the second will be converted to "src/main.c"
                 src = os.path.normpath(os.path.join(unit.directory, source.strip()))
-                srchash = strhash(unit.name+":"+src)
+                srchash = objhash(unit, src)
                 # add to unit.objects
-                unit.objects.append("build/obj/"+srchash+".o")
+                unit.objects.append(outdir()+"/obj/"+srchash+".o")
                 
             unit.dat['SOURCES'] = newsources
 
             if not unit.changed:
-                # check hash of build file
-                path = os.path.join(unit.directory, "sibs.txt")
-                path = os.path.normpath(path)
-                if not sibsopt_nohcache:
-                    if path not in hashcache.hcache:
-                        hashcache.setbytes(path, filedigest("sibs.txt"))
-                        unit.changed = True
-                    else:
-                        if hashcache.gethash(path) != filedigest("sibs.txt"):
-                            hashcache.setbytes(path, filedigest("sibs.txt"))
-                            unit.changed = True
-                else:
-                    unit.changed = True
+                # objects of this configuration may have been removed
+                for obj in unit.objects:
+                    if not os.path.exists(os.path.join(firstpath, obj)):
+                        markchanged(unit, f"object '{obj}' missing")
+                        break
+
+            # check hash of build file, this is always recorded (even if a source already changed)
+            # so the next build doesn't see it as new, and it is per unit since units share a sibs.txt
+            # and per compile commands like the sources, an edit seen with other flags still rebuilds these objects
+            path = os.path.join(unit.directory, "sibs.txt")
+            path = os.path.normpath(path)+":"+unit.name+":"+unit.compilehash
+            builddigest = filedigest(os.path.join(here, "sibs.txt"))
+            if not sibsopt_nohcache:
+                if hashcache.gethash(path) == None:
+                    hashcache.setbytes(path, builddigest)
+                    markchanged(unit, f"'{os.path.normpath(os.path.join(unit.directory, 'sibs.txt'))}' is new")
+                elif hashcache.gethash(path) != builddigest:
+                    hashcache.setbytes(path, builddigest)
+                    markchanged(unit, f"'{os.path.normpath(os.path.join(unit.directory, 'sibs.txt'))}' changed")
+            else:
+                markchanged(unit, "--nohcache")
+            state.update(builddigest)
+            unit.statedigest = state.digest()
 
-                        
     for unit in toremove:
         units.remove(unit)
 
     print(f"Optimizing done ({len(units)} units)")
 
-    os.chdir(originalpath)
     return (units, commands)
 
 
-def docompile(units: list[BuildUnit], unit: BuildUnit) -> list[str]:
+def depchanges(units: list[BuildUnit]):
+    # a --target build records the new digests of the units it builds, but not for the units that use them
+    # so every unit also keeps what its dependencies were when it was last configured, and rebuilds if that changed
+    # called on all the loaded units, a unit can depend on units of the sibs.txt that imports its own
+    if sibsopt_nohcache:
+        return
+    for unit in units:
+        if not unit.docompile:
+            continue
+        deps = sorted({dep.name: dep for dep in getdeps(units, unit)}.values(), key=lambda dep: dep.name)
+        depstate = hashlib.sha256(b"".join(dep.name.encode()+b"\0"+dep.statedigest for dep in deps)).digest()
+        key = "deps:"+unit.name+":"+unit.compilehash
+        if hashcache.gethash(key) == None:
+            hashcache.setbytes(key, depstate)
+        elif hashcache.gethash(key) != depstate:
+            hashcache.setbytes(key, depstate)
+            markchanged(unit, "a dependency changed since it was last built")
+
+@dataclass
+class CompileStep:
+    unit: BuildUnit
+    src: str
+    out: str
+    key: str # the source's entry in the hash cache
+    commands: list[str] # passed through compilecmd, $SRC and $OUT are replaced when the commands are expanded
+    cwd: str # the project root, src and out are relative to it
+
+    def templates(self) -> list[str]:
+        return self.commands
+
+    def cmdlines(self) -> list[str]:
+        return [command.replace("$SRC", self.src).replace("$OUT", self.out) for command in self.commands]
+
+    def label(self) -> str:
+        return self.src
+
+def docompile(units: list[BuildUnit], unit: BuildUnit) -> list[CompileStep]:
     commands = []
     if not unit.docompile:
         return []
@@ -750,7 +1404,7 @@ def docompile(units: list[BuildUnit], unit: BuildUnit) -> list[str]:
     for dep in deps:
         if dep.out_type == 'OBJ':
             depobjs += dep.objects
-        elif dep.out_type != 'DYN' and dep.out_type != 'STATIC':
+        elif dep.out_type != 'DYN' and dep.out_type != 'STATIC' and dep.out_type != 'GEN':
             print(f"Invalid dependency '{dep.name}' (type '{dep.out_type}') for unit '{unit.name}'")
         depinc += dep.incstr
         if dep.changed:
@@ -761,20 +1415,35 @@ def docompile(units: list[BuildUnit], unit: BuildUnit) -> list[str]:
         if source.strip() == "":
             continue
         src = os.path.normpath(os.path.join(unit.directory, source.strip()))
-        srchash = strhash(unit.name+":"+src)
-        out = f"build/obj/{srchash}.o"
+        srchash = objhash(unit, src)
+        out = f"{outdir()}/obj/{srchash}.o"
         if out in unit.objects:
+            stepcmds = []
             for command in compiles:
                 if command.strip() == "":
                     continue
-                commands.append(command.replace("$SRC", src).replace("$OUT", out)+depinc+unit.incstr)
+                stepcmds.append(compilecmd(command+depinc+unit.incstr))
+            commands.append(CompileStep(unit, src, out, srchash, stepcmds, firstpath))
         else:
             print(f"Error: source '{src}' not configured for unit '{unit.name}'")
             exit(1)
     
     return commands
 
-def dolink(units: list[BuildUnit], unit: BuildUnit) -> list[str]:
+@dataclass
+class LinkStep:
+    # a link is only decided on when it is about to run, because the objects it
+    # consumes are produced by the compile commands that run before it
+    # everything it needs from the toolchain and the options is taken when it is made, so it can run without them
+    unit: BuildUnit
+    inputs: list[str] # relative to the project root, like the output
+    commands: list[str] # passed through compilecmd
+    identity: str # of the toolchain, part of the signature
+    ar: str # the archiver, to list the members of an archive
+    arcmd: str # $AR passed through compilecmd, for updating an archive in place
+    inplace: bool # a static archive with the default command, only its changed members are replaced
+
+def dolink(units: list[BuildUnit], unit: BuildUnit) -> list[LinkStep]:
     commands = []
     if not unit.dolink:
         return []
@@ -784,159 +1453,761 @@ def dolink(units: list[BuildUnit], unit: BuildUnit) -> list[str]:
     objs = unit.objects
     depobjs = []
     deplibs = []
-    needa_link = False
-    if unit.changed:
-        needa_link = True
+    # there is no need to look at the changed flags, the link step decides from its inputs
+    # (which also catches objects that moved because of other flags or configurations)
     for dep in getdeps(units, unit):
-        if dep.changed:
-            needa_link = True
         if dep.out_type == 'OBJ':
             depobjs += dep.objects
         elif dep.out_type == 'DYN':
             deplibs += dep.dynamic
         elif dep.out_type == 'STATIC':
             deplibs += dep.static
+        elif dep.out_type == 'GEN':
+            pass # its outputs are compiled into this unit
         else:
             print(f"Invalid dependency '{dep.name}' (type '{dep.out_type}')")
             exit(1)
-    if not needa_link:
-        return []
+    inputs = objs+depobjs+deplibs
     for command in unit.dat['LINK'].split('\n'):
         if command.strip() == "":
             continue
-        commands.append(command.replace('$SRC', ' '.join(objs+depobjs+deplibs)).replace('$OUT', unit.thisoutput))
-    
-    return commands
+        commands.append(compilecmd(command.replace('$SRC', ' '.join(inputs)).replace('$OUT', unit.thisoutput)))
+    inplace = unit.out_type == 'STATIC' and unit.dat['LINK'] == defaultstatic
+    return [LinkStep(unit, inputs, commands, toolchain.identity(), toolchain.ar, compilecmd("$AR"), inplace)]
+
+def linkorder(units: list[BuildUnit], links: list[LinkStep]) -> list[LinkStep]:
+    # a unit is linked after the units it depends on, whatever order they are in the sibs.txt
+    byunit = {id(link.unit): link for link in links}
+    seen = set()
+    ordered = []
+    def visit(unit: BuildUnit):
+        if id(unit) in seen:
+            return
+        seen.add(id(unit))
+        for dep in getdirectdeps(units, unit):
+            visit(dep)
+        if id(unit) in byunit:
+            ordered.append(byunit[id(unit)])
+    for link in links:
+        visit(link.unit)
+    return ordered
+
+def linksignature(step: LinkStep, root: str) -> bytes:
+    # hash of the expanded link commands and the contents of every input
+    # if an input is missing we can't know anything, so we return None
+    h = hashlib.sha256()
+    h.update(step.identity.encode()+b"\n")
+    for command in step.commands:
+        h.update(command.encode()+b"\n")
+    for inp in step.inputs:
+        path = os.path.join(root, inp)
+        if not os.path.exists(path):
+            return None
+        h.update(inp.encode()+b"\0"+filedigest(path))
+    return h.digest()
+
+def linkcmdsignature(step: LinkStep) -> bytes:
+    # the command and toolchain part of linksignature, an archive can only be updated in place if it is the same
+    h = hashlib.sha256()
+    h.update(step.identity.encode()+b"\n")
+    for command in step.commands:
+        h.update(command.encode()+b"\n")
+    return h.digest()
+
+def linkstat(step: LinkStep, root: str) -> bytes:
+    # cheap version of linksignature from the sizes and mtimes, so no-op builds don't read every input
+    h = hashlib.sha256()
+    h.update(step.identity.encode()+b"\n")
+    for command in step.commands:
+        h.update(command.encode()+b"\n")
+    for inp in step.inputs:
+        path = os.path.join(root, inp)
+        if not os.path.exists(path):
+            return None
+        st = os.stat(path)
+        h.update(f"{inp}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+    return h.digest()
+
+def archivemembers(ar: str, path: str) -> list[str]:
+    a = subprocess.run(ar.split()+["t", path], capture_output=True)
+    if a.returncode != 0:
+        return None
+    return [m.strip() for m in a.stdout.decode().split('\n') if m.strip() != ""]
+
+def linkstepcmds(step: LinkStep, root: str, hc: HashCache, nohcache: bool) -> tuple[list[str], bytes]:
+    # returns the commands that actually need to run for this link (in root)
+    # and the signature to store once they succeed
+    out = step.unit.thisoutput
+    outpath = os.path.join(root, out)
+    commands = step.commands
+    if nohcache:
+        return (commands, None)
+    if os.path.exists(outpath):
+        stat = linkstat(step, root)
+        if stat != None and hc.gethash("linkstat:"+out) == stat:
+            hc.touch("link:"+out)
+            hc.touch("linkcmd:"+out)
+            for inp in step.inputs:
+                hc.touch("ar:"+out+":"+inp)
+            return ([], None)
+    sig = linksignature(step, root)
+    if sig == None:
+        return (commands, sig)
+    if os.path.exists(outpath) and hc.gethash("link:"+out) == sig:
+        print(f"Skipping link of '{step.unit.name}' (inputs unchanged)")
+        return ([], sig)
+
+    # static archives with the default command are updated in place, only the changed members are replaced
+    if not step.inplace or not os.path.exists(outpath):
+        return (commands, sig)
+    if hc.gethash("linkcmd:"+out) != linkcmdsignature(step):
+        # the archiver or its flags changed, ar -rcs would only add to the old archive, so it is made again
+        os.remove(outpath)
+        return (commands, sig)
+    if any(not inp.endswith(".o") for inp in step.inputs):
+        return (commands, sig)
+    members = archivemembers(step.ar, outpath)
+    if members == None:
+        return (commands, sig)
+    names = [os.path.basename(inp) for inp in step.inputs]
+    if len(set(names)) != len(names):
+        return (commands, sig)
+    changed = []
+    for inp in step.inputs:
+        if os.path.basename(inp) not in members or hc.gethash("ar:"+out+":"+inp) != filedigest(os.path.join(root, inp)):
+            changed.append(inp)
+    removed = [m for m in members if m not in names]
+    commands = []
+    if len(removed) > 0:
+        commands.append(f"{step.arcmd} -d {out} "+' '.join(removed))
+    if len(changed) > 0:
+        commands.append(f"{step.arcmd} -rcs {out} "+' '.join(changed))
+    return (commands, sig)
+
+def linkstepdone(step: LinkStep, sig: bytes, root: str, hc: HashCache, nohcache: bool):
+    if nohcache or sig == None:
+        return
+    out = step.unit.thisoutput
+    if step.inplace:
+        for inp in step.inputs:
+            digest = filedigest(os.path.join(root, inp))
+            if hc.gethash("ar:"+out+":"+inp) != digest:
+                hc.setbytes("ar:"+out+":"+inp, digest)
+    if hc.gethash("link:"+out) != sig:
+        hc.setbytes("link:"+out, sig)
+    if hc.gethash("linkcmd:"+out) != linkcmdsignature(step):
+        hc.setbytes("linkcmd:"+out, linkcmdsignature(step))
+    stat = linkstat(step, root)
+    if stat != None and hc.gethash("linkstat:"+out) != stat:
+        hc.setbytes("linkstat:"+out, stat)
+
+FICLONE = 0x40049409 # linux ioctl for reflinks (btrfs, xfs, ...)
+
+def sameoutput(src: str, dst: str) -> bool:
+    if not os.path.exists(dst):
+        return False
+    if os.path.samefile(src, dst):
+        return True
+    srcst = os.stat(src)
+    dstst = os.stat(dst)
+    if srcst.st_size != dstst.st_size:
+        return False
+    if srcst.st_mtime_ns == dstst.st_mtime_ns:
+        return True
+    return filedigest(src) == filedigest(dst)
+
+def stageoutput(src: str, dst: str) -> bool:
+    # puts src at dst without rewriting dst if it is already the same
+    # tries a hardlink first, then a reflink, and only copies if neither is supported
+    # returns True if dst was (re)written
+    if sameoutput(src, dst):
+        return False
+    tmp = dst+".sibstmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        try:
+            import fcntl
+            with open(src, "rb") as fs, open(tmp, "wb") as fd:
+                fcntl.ioctl(fd.fileno(), FICLONE, fs.fileno())
+            shutil.copystat(src, tmp)
+        except (OSError, ImportError):
+            shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+    return True
+
+def prunestaged(staged: list[str], root: str, odir: str):
+    # remove outputs that were staged by a previous build but aren't anymore
+    # staged and the log are relative to root, odir is the output directory of the configuration
+    stagedlog = os.path.join(root, odir, "staged.txt")
+    if os.path.exists(stagedlog):
+        with open(stagedlog, "r") as f:
+            for ln in f.readlines():
+                ln = ln.strip()
+                if ln == "" or ln in staged:
+                    continue
+                if os.path.exists(os.path.join(root, ln)):
+                    print(f"Removing stale output {ln}")
+                    os.remove(os.path.join(root, ln))
+    with open(stagedlog, "w") as f:
+        for st in staged:
+            f.write(st+"\n")
+
+def changechains(units: list[BuildUnit], unit: BuildUnit, path: list[str]) -> list[str]:
+    # the reasons of this unit and of every changed dependency, with the chain of dependencies that leads to them
+    lines = [" -> ".join(path)+": "+reason for reason in unit.reasons]
+    for dep in getdirectdeps(units, unit):
+        if dep.name in path:
+            continue
+        lines += changechains(units, dep, path+[dep.name])
+    return lines
+
+def explainlink(step: LinkStep, willrun: set[str], root: str, hc: HashCache, nohcache: bool) -> list[str]:
+    # why the link would run, nothing if it is up to date
+    out = step.unit.thisoutput
+    if nohcache:
+        return ["--nohcache"]
+    if not os.path.exists(os.path.join(root, out)):
+        return [f"output '{out}' missing"]
+    reasons = []
+    for inp in step.inputs:
+        if inp in willrun:
+            reasons.append(f"input '{inp}' will be rebuilt (the link is skipped if it comes out the same)")
+        elif not os.path.exists(os.path.join(root, inp)):
+            reasons.append(f"input '{inp}' missing")
+    if len(reasons) > 0:
+        return reasons
+    if hc.gethash("linkstat:"+out) == linkstat(step, root):
+        return []
+    if hc.gethash("link:"+out) == linksignature(step, root):
+        return []
+    return ["inputs or link commands changed since the last link"]
 
-def compilecmd(cmd: str) -> str:
-    # we need to replace the cxx cxxl, cc, ccl, and ar commands
-    # TODO: we should make this more robust for other compilers
-    # cmd = cmd.replace("$CXXL", "g++")
-    # cmd = cmd.replace("$CXX", "g++")
-    # cmd = cmd.replace("$CCL", "gcc")
-    # cmd = cmd.replace("$CC", "gcc")
-    # cmd = cmd.replace("$AR", "ar")
+@dataclass
+class PlannedCommand:
+    # one entry of a plan, a link that is up to date has no commands
+    kind: str # "compile", "generate", "link", "cmake" or "command" (plain BUILDCMDS)
+    unit: str # "" for plain commands and unnamed generators
+    commands: list[str]
+    reasons: list[str]
+
+def planentries(units: list[BuildUnit], cmds: list) -> list[PlannedCommand]:
+    # every command the build would run and why
+    cmakecmds = {}
+    for unit in units:
+        if unit.cmakebuilddir != "":
+            cmakecmds["cmake --build "+unit.cmakebuilddir+" --target "+unit.cmaketarget] = unit
+    willrun = set()
+    entries = []
+    for cmd in cmds:
+        if isinstance(cmd, CompileStep):
+            entry = PlannedCommand("compile", cmd.unit.name, cmd.cmdlines(), changechains(units, cmd.unit, [cmd.unit.name]))
+            willrun.add(cmd.out)
+        elif isinstance(cmd, GenStep):
+            lines = [f"(in {os.path.relpath(cmd.cwd, firstpath)}) "+line for line in cmd.cmdlines()]
+            entry = PlannedCommand("generate", cmd.unit.name if cmd.unit != None else "", lines, cmd.reasons)
+            willrun.update(cmd.produces())
+        elif isinstance(cmd, LinkStep):
+            reasons = explainlink(cmd, willrun, firstpath, hashcache, sibsopt_nohcache)
+            entry = PlannedCommand("link", cmd.unit.name, [], reasons)
+            if len(reasons) > 0:
+                entry.commands = cmd.commands
+                willrun.add(cmd.unit.thisoutput)
+        elif cmd in cmakecmds:
+            entry = PlannedCommand("cmake", cmakecmds[cmd].name, [cmd], changechains(units, cmakecmds[cmd], [cmakecmds[cmd].name]))
+            willrun.add(cmakecmds[cmd].thisoutput)
+        else:
+            entry = PlannedCommand("command", "", [cmd], ["BUILDCMDS always run"])
+        entry.reasons = list(dict.fromkeys(entry.reasons))
+        entries.append(entry)
+    return entries
+
+def printplan(entries: list[PlannedCommand], explain: bool):
+    # prints every command the build would run, with --explain also why
+    planned = 0
+    for entry in entries:
+        if len(entry.commands) == 0:
+            if explain:
+                print(f"Up to date: {entry.kind} of '{entry.unit}'")
+            continue
+        planned += len(entry.commands)
+        for line in entry.commands:
+            print(line)
+        if explain:
+            for reason in entry.reasons:
+                print(f"    because {reason}")
+    print(f"Plan done ({planned} commands)")
+
+def pruneobjects(units: list[BuildUnit], root: str, odir: str) -> int:
+    # removes objects of this configuration (odir, relative to root) that no unit uses anymore
+    used = set()
+    for unit in units:
+        used.update(os.path.normpath(obj) for obj in unit.objects)
+    removed = 0
+    objdir = odir+"/obj"
+    if not os.path.exists(os.path.join(root, objdir)):
+        return 0
+    for f in os.listdir(os.path.join(root, objdir)):
+        path = os.path.normpath(os.path.join(objdir, f))
+        if f.endswith(".o") and path not in used:
+            os.remove(os.path.join(root, path))
+            removed += 1
+    return removed
+
+def stepkey(cmd) -> str:
+    # the name a command's duration is kept under in the timing history
+    if isinstance(cmd, CompileStep) or isinstance(cmd, GenStep):
+        return cmd.key
+    if isinstance(cmd, LinkStep):
+        return "link:"+cmd.unit.name
+    return "cmd:"+strhash(cmd)
+
+def steplabel(cmd) -> str:
+    if isinstance(cmd, LinkStep):
+        return f"Linking {cmd.unit.name}"
+    if isinstance(cmd, str):
+        return cmd
+    return cmd.label()
+
+def readtimings(path: str) -> dict[str, float]:
+    # how long each command took the last time it ran, in seconds
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        try:
+            return json.load(f)
+        except ValueError:
+            return {}
+
+def writetimings(path: str, timings: dict[str, float]):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path+".tmp", "w") as f:
+        json.dump(timings, f)
+    os.replace(path+".tmp", path)
+
+def prefixmapflags() -> str:
+    # so debug info and __FILE__ don't have the project root in them, and objects are the same wherever it is
+    if not sibsopt_prefixmap:
+        return ""
+    return " "+shlex.quote(f"-ffile-prefix-map={firstpath}=.")
+
+def compilecmd(cmd: str, prefixmap: bool = True) -> str:
+    # we need to replace the cxx cxxl, cc, ccl, and ar commands with the toolchain
     # if the command contains CC or CXX add cflags
     # if the command contains CC add ccflags
     # if the command contains CXX add cxxflags
-    # if the command contains CCL or CXXL add ldflags
+    # if the command contains CCL or CXXL add ldflags (and the linker choice)
     # if the command contains CCL add cclflags
     # if the command contains CXXL add cxxlflags
     # if the command contains AR add arflags
-    cmd = cmd.replace("$CXXL", f"g++ {sibsopt_ldflags} {sibsopt_cxxlflags}")
-    cmd = cmd.replace("$CXX", f"g++ {sibsopt_cflags} {sibsopt_cxxflags}")
-    cmd = cmd.replace("$CCL", f"gcc {sibsopt_ldflags} {sibsopt_cclflags}")
-    cmd = cmd.replace("$CC", f"gcc {sibsopt_cflags} {sibsopt_ccflags}")
-    cmd = cmd.replace("$AR", f"ar {sibsopt_arflags}")
+    # if the command contains CC or CXX add the prefix map (unless prefixmap is False)
+    # this is done in one pass, so $CC can't eat the start of $CCL
+    pm = prefixmapflags() if prefixmap else ""
+    tools = {
+        "CXXL": f"{toolchain.cxx}{toolchain.ldflag(toolchain.cxx)} {sibsopt_ldflags} {sibsopt_cxxlflags}",
+        "CXX": f"{toolchain.cxx}{pm} {sibsopt_cflags} {sibsopt_cxxflags}",
+        "CCL": f"{toolchain.cc}{toolchain.ldflag(toolchain.cc)} {sibsopt_ldflags} {sibsopt_cclflags}",
+        "CC": f"{toolchain.cc}{pm} {sibsopt_cflags} {sibsopt_ccflags}",
+        "AR": f"{toolchain.ar} {sibsopt_arflags}",
+    }
+    return re.sub(r"\$(CXXL|CXX|CCL|CC|AR)(?![A-Za-z0-9_])", lambda m: tools[m.group(1)], cmd)
 
-    return cmd
 
 
+@dataclass
+class Options:
+    # the command line options, a Project has its own instead of using the sibsopt_ globals
+    nohcache: bool = False
+    nohashdir: bool = False
+    cflags: str = ""
+    ccflags: str = ""
+    ldflags: str = ""
+    cxxflags: str = ""
+    cxxlflags: str = ""
+    cclflags: str = ""
+    arflags: str = ""
+    showcommands: bool = False
+    config: str = ""
+    jobs: int = 1
+    dryrun: bool = False
+    explain: bool = False
+    cachegc: bool = False
+    cc: str = ""
+    cxx: str = ""
+    ar: str = ""
+    ld: str = ""
+    workers: list[str] = field(default_factory=lambda: [])
+    targets: list[str] = field(default_factory=lambda: [])
+    prefixmap: bool = True
+
+def applyoptions(opts: Options):
+    # the rest of sibs reads the sibsopt_ globals, this sets them from opts
+    for name, value in vars(opts).items():
+        globals()["sibsopt_"+name] = value
+    if opts.config in configpresets:
+        globals()["sibsopt_cflags"] = opts.cflags+" "+configpresets[opts.config]
+
+class SibsError(Exception):
+    pass
 
-def main():
-    global sibsopt_nohashdir
-    global sibsopt_nohcache
-    global sibsopt_cflags
-    global sibsopt_ccflags
-    global sibsopt_ldflags
-    global sibsopt_cxxflags
-    global sibsopt_cxxlflags
-    global sibsopt_cclflags
-    global sibsopt_arflags
-    global sibsopt_showcommands
-    charg = ""
-    if len(sys.argv) > 1:
-        for arg in sys.argv[1:]:
-            if arg.startswith("--"):
-                if arg == "--nohashdir" or arg == "--nocmakepersist":
-                    sibsopt_nohashdir = True
-                elif arg == "--nohcache" or arg == "--nopersist":
-                    sibsopt_nohcache = True
-                elif arg.startswith("--cflags="):
-                    sibsopt_cflags += " "+arg[len("--cflags="):]
-                elif arg.startswith("--ccflags="):
-                    sibsopt_ccflags += " "+arg[len("--ccflags="):]
-                elif arg.startswith("--ldflags="):
-                    sibsopt_ldflags += " "+arg[len("--ldflags="):]
-                elif arg.startswith("--cxxflags="):
-                    sibsopt_cxxflags += " "+arg[len("--cxxflags="):]
-                elif arg.startswith("--cxxlflags="):
-                    sibsopt_cxxlflags += " "+arg[len("--cxxlflags="):]
-                elif arg.startswith("--cclflags="):
-                    sibsopt_cclflags += " "+arg[len("--cclflags="):]
-                elif arg.startswith("--arflags="):
-                    sibsopt_arflags += " "+arg[len("--arflags="):]
-                elif arg.startswith("--debug"):
-                    sibsopt_cflags += " -g"
-                    sibsopt_ldflags += " -g"
-                elif arg.startswith("--showcommands"):
-                    sibsopt_showcommands = True
-                elif arg == "--help":
-                    print("SIBS: Simply Integrated Build System")
-                    print("Version: v"+sibsversion)
-                    print("Usage:")
-                    print("python -m sibs (directory) (--nocmakepersist/--nohashdir --nohcache/--nopersist --cflags=... --ccflags=... --ldflags=... --cxxflags=... --cxxlflags=... --cclflags=... --arflags=... --debug --help)")
-                    print("Options:")
-                    print("    --nocmakepersist/nohashdir: Cmake imported projects will not persist between builds, this will make them rebuild every time (very slow)")
-                    print("    --nohcache/nopersist: Don't use the hash cache, this will make even local projects rebuild every time, no matter if there are changes (very slow)")
-                    print("    --cflags=: Extra flags to pass to the C/C++ compiler")
-                    print("    --ccflags=: Extra flags to pass to the C compiler")
-                    print("    --cxxflags=: Extra flags to pass to the C++ compiler")
-                    print("    --ldflags=: Extra flags to pass to the C/C++ linker")
-                    print("    --cclflags=: Extra flags to pass to the C linker")
-                    print("    --cxxlflags=: Extra flags to pass to the C++ linker")
-                    print("    --arflags=: Extra flags to pass to the archiver")
-                    print("    --debug: Adds -g to all compile commands")
-                    print("    --showcommands: Shows the commands that will be executed")
-
-                    print("    --help: Print this help message")
-                    exit(0)
+@dataclass
+class BuildResult:
+    ran: int # commands that ran
+    failed: list[str] # the commands (or sources) that failed
+    outputs: dict[str, str] # unit name -> absolute path of its output
+
+    @property
+    def ok(self) -> bool:
+        return len(self.failed) == 0
+
+# loading reads the sibsopt_ globals (and the root, cache and toolchain globals), so projects take turns loading
+# running doesn't, the steps carry their commands and Project.run gets the root and options,
+# so builds of different projects run at the same time, and sibs never changes the current directory
+buildlock = threading.RLock()
+
+class Project:
+    # a project loaded for building from python, e.g.
+    #     project = Project.load("path/to/project", Options(config="release"))
+    #     for entry in project.plan(): ...
+    #     result = project.build(jobs=8, targets=["app"])
+    # the hash cache, timing history, toolchain probes and cmake configures stay in memory between calls,
+    # the units are loaded again for every plan and build, since that is how changes are found
+    # calls on one project wait for each other, different projects build at the same time
+    def __init__(self, path: str, options: Options = None):
+        self.root = os.path.abspath(path)
+        self.options = options if options != None else Options()
+        self.odir = configdir(self.options.config)
+        self.hashcache = HashCache(os.path.join(self.root, self.odir, "sibs.hcache"))
+        self.toolchain = Toolchain()
+        self.lock = threading.Lock()
+        self.history = None
+        self.cmakeconfigs = {}
+        self.units = [] # from the last plan or build
+
+    @classmethod
+    def load(cls, path: str, options: Options = None) -> "Project":
+        if not os.path.exists(os.path.join(path, "sibs.txt")):
+            raise SibsError(f"no sibs.txt file found in '{path}'")
+        project = cls(path, options)
+        with project.active() as opts:
+            project.toolchain = picktoolchain()
+            if not opts.nohcache:
+                project.hashcache.read()
+            project.history = readtimings(os.path.join(project.root, project.odir, "timings.json"))
+        return project
+
+    @contextmanager
+    def active(self, **overrides):
+        # puts this project's options, root, cache and toolchain in the globals, for loading
+        global firstpath
+        global hashcache
+        global toolchain
+        global cmakeconfigs
+        opts = Options(**{**vars(self.options), **{k: v for k, v in overrides.items() if v != None}})
+        with buildlock:
+            saved = ({name: globals()["sibsopt_"+name] for name in vars(opts)}, firstpath, hashcache, toolchain, cmakeconfigs)
+            applyoptions(opts)
+            firstpath = self.root
+            hashcache = self.hashcache
+            hashcache.readonly = opts.dryrun
+            toolchain = self.toolchain
+            cmakeconfigs = self.cmakeconfigs
+            try:
+                yield opts
+            except SystemExit as e:
+                # loading and building report their errors and exit, like the command line expects
+                if e.code in (0, None):
+                    raise
+                raise SibsError("sibs stopped, see the messages above") from e
+            finally:
+                for name, value in saved[0].items():
+                    globals()["sibsopt_"+name] = value
+                firstpath, hashcache, toolchain, cmakeconfigs = saved[1:5]
+
+    def configure(self, opts: Options) -> tuple[list[BuildUnit], list, dict[int, int]]:
+        # loads the units and makes the commands, in the order they run
+        if len(opts.targets) > 0:
+            units, cmds = loadunits(".", wanted=set(opts.targets))
+            for t in opts.targets:
+                if finddep(units, t) == None:
+                    raise SibsError(f"target '{t}' not found")
+        else:
+            units, cmds = loadunits(".")
+        depchanges(units)
+        gens = [cmd for cmd in cmds if isinstance(cmd, GenStep)]
+        genlevels = ordergens(gens)
+
+        print(f"Building unit commands...")
+
+        # plain BUILDCMDS and cmake builds first, then generators and compiles (which can run together), then links
+        cmds = [compilecmd(cmd) for cmd in cmds if not isinstance(cmd, GenStep)]+[g for g in gens if g.willrun]
+        links = []
+        for unit in units:
+            if unit.skip:
+                continue
 
+            if unit.docompile:
+                cmds += docompile(units, unit)
+            if unit.dolink:
+                links += dolink(units, unit)
+        cmds += linkorder(units, links)
+        self.units = units
+
+        print(f"Building unit commands done ({len(cmds)} commands)")
+        return (units, cmds, genlevels)
+
+    def plan(self, targets: list[str] = None) -> list[PlannedCommand]:
+        # what build() would run and why, nothing is run or stored
+        with self.lock, self.active(targets=targets, dryrun=True) as opts:
+            units, cmds, genlevels = self.configure(opts)
+            return planentries(units, cmds)
+
+    def build(self, jobs: int = None, targets: list[str] = None) -> BuildResult:
+        with self.lock:
+            with self.active(jobs=jobs, targets=targets) as opts:
+                if opts.dryrun:
+                    # nothing would be recorded, but everything would run
+                    raise SibsError("the project is set up for dry runs, use plan() to see what would run")
+                if opts.cachegc and len(opts.targets) > 0:
+                    raise SibsError("--cache-gc needs a full build, it can't be used with --target")
+                self.hashcache.used = set()
+                units, cmds, genlevels = self.configure(opts)
+                if opts.explain:
+                    printplan(planentries(units, cmds), True)
+            # the globals are given back here, another project can load while this one runs
+            return self.run(opts, units, cmds, genlevels)
+
+    def run(self, opts: Options, units: list[BuildUnit], cmds: list, genlevels: dict[int, int]) -> BuildResult:
+        # runs the commands of configure() in the project root, with opts instead of the sibsopt_ globals
+        root = self.root
+        hc = self.hashcache
+        os.makedirs(os.path.join(root, self.odir, "obj"), exist_ok=True)
+        os.makedirs(os.path.join(root, "build", "cmake"), exist_ok=True)
+
+        ran = 0
+        failed = []
+        progress = Progress(len(cmds), self.history, opts.jobs)
+        progress.add([stepkey(cmd) for cmd in cmds])
+        executor = makeexecutor(opts.jobs, opts.workers, opts.showcommands, progress)
+        batch = []
+        # consecutive compile and generator steps are handed to the executor together,
+        # in waves so compiles wait for the generators they need
+        for cmd in cmds+[None]:
+            if isinstance(cmd, CompileStep) or isinstance(cmd, GenStep):
+                batch.append(cmd)
+                continue
+            if len(batch) > 0:
+                for wave in batchwaves(units, batch, genlevels):
+                    # the longest steps (from the timing history) start first, so they don't finish last alone
+                    wave.sort(key=lambda step: -progress.estimate(step.key))
+                    for step, ok in zip(wave, executor.runall(wave)):
+                        if not ok:
+                            failed.append(step.label())
+                        if isinstance(step, GenStep):
+                            if ok:
+                                gendone(step, hc, opts.nohcache)
+                        elif not ok:
+                            # so the next build tries again
+                            hc.delkey(step.key)
+                ran += len(batch)
+                batch = []
+            if cmd == None:
+                break
+            if isinstance(cmd, LinkStep):
+                progress.external()
+                linkcmds, sig = linkstepcmds(cmd, root, hc, opts.nohcache)
+                if len(linkcmds) == 0:
+                    linkstepdone(cmd, sig, root, hc, opts.nohcache)
+                    progress.skip(stepkey(cmd))
+                    continue
+                progress.begin(stepkey(cmd))
+                linkfailed = False
+                for c in linkcmds:
+                    ran += 1
+                    if runlocal(c, opts.showcommands, root, progress) != 0:
+                        linkfailed = True
+                if not linkfailed:
+                    linkstepdone(cmd, sig, root, hc, opts.nohcache)
                 else:
-                    print(f"Unknown option '{arg}'")
-            else:
-                if charg != "":
-                    print(f"Unknown option '{charg}'")
-                charg = arg
-  
-    if charg == "":
-        charg = "."
-
-    if not os.path.exists(os.path.join(charg, "sibs.txt")):
-        print("Error: no sibs.txt file found!")
-        exit(1)
+                    failed.append(steplabel(cmd))
+                progress.end(stepkey(cmd), steplabel(cmd), not linkfailed)
+                continue
+            progress.begin(stepkey(cmd))
+            ran += 1
+            ok = runlocal(cmd, opts.showcommands, root, progress) == 0
+            if not ok:
+                failed.append(cmd)
+            progress.end(stepkey(cmd), steplabel(cmd), ok)
+        executor.close()
+        progress.finish()
+        self.history.update(progress.timings)
+        writetimings(os.path.join(root, self.odir, "timings.json"), self.history)
+
+        if ran == 0:
+            print("Nothing to build!")
+
+        staged = []
+        for unit in units:
+            if unit.skip and unit.thisoutput != None and unit.thisoutput.strip() != "": # this means cmake
+                # stage the cmake output in the build directory
+                if not os.path.exists(os.path.join(root, unit.thisoutput)):
+                    print(f"Warning: cmake output '{unit.thisoutput}' does not exist")
+                    continue
+                dst = self.odir+"/"+os.path.basename(unit.thisoutput)
+                if stageoutput(os.path.join(root, unit.thisoutput), os.path.join(root, dst)):
+                    print(f"Staged {unit.thisoutput} to {dst}")
+                staged.append(dst)
+        if len(opts.targets) == 0:
+            # the outputs of units that weren't built this time aren't stale
+            prunestaged(staged, root, self.odir)
+
+        if opts.cachegc and not opts.nohcache:
+            kept, before = hc.write(gc=True)
+            removed = pruneobjects(units, root, self.odir)
+            print(f"Cache GC: kept {kept} of {before} entries, removed {removed} unused objects")
+        else:
+            hc.write()
 
+        outputs = {}
+        for unit in units:
+            if unit.thisoutput != None and unit.thisoutput.strip() != "":
+                outputs[unit.name] = os.path.join(root, unit.thisoutput)
+        return BuildResult(ran, failed, outputs)
 
+    def close(self):
+        self.hashcache.close()
 
-    units, cmds = loadunits(charg)
+def parseargs(args: list[str]) -> tuple[Options, str, str]:
+    # returns the options, the project directory and the worker address (if sibs should run as a worker)
+    opts = Options()
+    workeraddr = ""
+    charg = ""
+    for arg in args:
+        if arg.startswith("--"):
+            if arg == "--nohashdir" or arg == "--nocmakepersist":
+                opts.nohashdir = True
+            elif arg == "--nohcache" or arg == "--nopersist":
+                opts.nohcache = True
+            elif arg == "--noprefixmap":
+                opts.prefixmap = False
+            elif arg.startswith("--cflags="):
+                opts.cflags += " "+arg[len("--cflags="):]
+            elif arg.startswith("--ccflags="):
+                opts.ccflags += " "+arg[len("--ccflags="):]
+            elif arg.startswith("--ldflags="):
+                opts.ldflags += " "+arg[len("--ldflags="):]
+            elif arg.startswith("--cxxflags="):
+                opts.cxxflags += " "+arg[len("--cxxflags="):]
+            elif arg.startswith("--cxxlflags="):
+                opts.cxxlflags += " "+arg[len("--cxxlflags="):]
+            elif arg.startswith("--cclflags="):
+                opts.cclflags += " "+arg[len("--cclflags="):]
+            elif arg.startswith("--arflags="):
+                opts.arflags += " "+arg[len("--arflags="):]
+            elif arg.startswith("--debug"):
+                opts.cflags += " -g"
+                opts.ldflags += " -g"
+            elif arg.startswith("--config="):
+                opts.config = arg[len("--config="):].strip()
+                if opts.config == "" or not all(c.isalnum() or c in "-_" for c in opts.config):
+                    print(f"Invalid configuration name '{opts.config}'")
+                    exit(1)
+            elif arg.startswith("--jobs="):
+                opts.jobs = int(arg[len("--jobs="):])
+                if opts.jobs < 1:
+                    print("Error: --jobs must be at least 1")
+                    exit(1)
+            elif arg.startswith("--workers="):
+                opts.workers += [w.strip() for w in arg[len("--workers="):].split(",") if w.strip() != ""]
+            elif arg.startswith("--worker="):
+                workeraddr = arg[len("--worker="):].strip()
+            elif arg == "--dry-run" or arg == "--dryrun":
+                opts.dryrun = True
+            elif arg.startswith("--toolchain="):
+                preset = arg[len("--toolchain="):].strip()
+                if preset not in toolchainpresets:
+                    print(f"Unknown toolchain '{preset}' (known: {', '.join(toolchainpresets)})")
+                    exit(1)
+                opts.cc, opts.cxx, opts.ar, opts.ld = toolchainpresets[preset]
+            elif arg.startswith("--cc="):
+                opts.cc = arg[len("--cc="):].strip()
+            elif arg.startswith("--cxx="):
+                opts.cxx = arg[len("--cxx="):].strip()
+            elif arg.startswith("--ar="):
+                opts.ar = arg[len("--ar="):].strip()
+            elif arg.startswith("--ld="):
+                opts.ld = arg[len("--ld="):].strip()
+            elif arg.startswith("--target="):
+                opts.targets += [t.strip() for t in arg[len("--target="):].split(",") if t.strip() != ""]
+            elif arg == "--cache-gc":
+                opts.cachegc = True
+            elif arg == "--explain":
+                opts.explain = True
+            elif arg.startswith("--showcommands"):
+                opts.showcommands = True
+            elif arg == "--help":
+                print("SIBS: Simply Integrated Build System")
+                print("Version: v"+sibsversion)
+                print("Usage:")
+                print("python -m sibs (directory) (--nocmakepersist/--nohashdir --nohcache/--nopersist --noprefixmap --config=... --jobs=... --workers=... --worker=... --target=... --dry-run --explain --cache-gc --toolchain=... --cc=... --cxx=... --ar=... --ld=... --cflags=... --ccflags=... --ldflags=... --cxxflags=... --cxxlflags=... --cclflags=... --arflags=... --debug --help)")
+                print("Options:")
+                print("    --nocmakepersist/nohashdir: Cmake imported projects will not persist between builds, this will make them rebuild every time (very slow)")
+                print("    --nohcache/nopersist: Don't use the hash cache, this will make even local projects rebuild every time, no matter if there are changes (very slow)")
+                print("    --noprefixmap: Don't pass -ffile-prefix-map=(project root)=. to the compiler (for compilers that don't support it)")
+                print("    --config=: Named build configuration, each one has its own objects, outputs and cache under build/config/<name>/ ('debug' adds -g, 'release' adds -O2 -DNDEBUG)")
+                print("    --jobs=: Number of compile commands to run at the same time (default 1)")
+                print("    --workers=: Comma separated host:port list of workers to send compiles to, falls back to local compiles if they are unavailable")
+                print("    --worker=: Run as a worker on [host:]port instead of building, only use this on trusted networks")
+                print("    --target=: Comma separated units to build (with the units they depend on), everything else isn't configured, hashed or built")
+                print("    --toolchain=: Use a preset toolchain: gcc (default), clang or llvm (clang, llvm-ar and lld)")
+                print("    --cc=, --cxx=, --ar=: C compiler, C++ compiler and archiver to use (default: $CC/$CXX/$AR or gcc/g++/ar)")
+                print("    --ld=: Linker for the compiler to link with, e.g. lld, mold or gold (default: $LD or the compiler's own)")
+                print("    --cflags=: Extra flags to pass to the C/C++ compiler")
+                print("    --ccflags=: Extra flags to pass to the C compiler")
+                print("    --cxxflags=: Extra flags to pass to the C++ compiler")
+                print("    --ldflags=: Extra flags to pass to the C/C++ linker")
+                print("    --cclflags=: Extra flags to pass to the C linker")
+                print("    --cxxlflags=: Extra flags to pass to the C++ linker")
+                print("    --arflags=: Extra flags to pass to the archiver")
+                print("    --debug: Adds -g to all compile commands")
+                print("    --showcommands: Shows the commands that will be executed")
+                print("    --dry-run: Print the commands that would run without running them or updating the hash cache")
+                print("               (cmake imports that were never configured are still configured, to know their targets)")
+                print("    --explain: Print why each command runs (what changed, through which dependencies)")
+                print("    --cache-gc: After building, drop hash cache entries and objects (of this configuration) that the build didn't use")
+
+                print("    --help: Print this help message")
+                exit(0)
 
-    print(f"Building unit commands...")
-    
-    for unit in units:
-        if unit.skip:
-            continue
-        
-        if unit.docompile:
-            cmds += docompile(units, unit)
-        if unit.dolink:
-            cmds += dolink(units, unit)
+            else:
+                print(f"Unknown option '{arg}'")
+        else:
+            if charg != "":
+                print(f"Unknown option '{charg}'")
+            charg = arg
 
-    os.makedirs("build/obj/", exist_ok=True)
-    os.makedirs("build/cmake/", exist_ok=True)
+    if charg == "":
+        charg = "."
+    return (opts, charg, workeraddr)
 
-    print(f"Building unit commands done ({len(cmds)} commands)")
-    for cmd in cmds:
-        c = compilecmd(cmd)
-        if sibsopt_showcommands:
-            print(c)
-        os.system(c)
-    
-    if len(cmds) == 0:
-        print("Nothing to build!")
+def main():
+    opts, charg, workeraddr = parseargs(sys.argv[1:])
+    if workeraddr != "":
+        runworker(workeraddr, opts.jobs)
         exit(0)
 
-    for unit in units:
-        if unit.skip and unit.thisoutput != None and unit.thisoutput.strip() != "": # this means cmake
-            # copy the cmake output to the build directory
-            print(f"Copying {unit.thisoutput} to build/"+os.path.basename(unit.thisoutput))
-            shutil.copyfile(unit.thisoutput, "build/"+os.path.basename(unit.thisoutput))
+    try:
+        # build/ and every path in the cache are relative to the project, not to where sibs was started
+        project = Project.load(charg, opts)
+        if opts.dryrun:
+            printplan(project.plan(), opts.explain)
+        else:
+            result = project.build()
+            if not result.ok:
+                print(f"Error: build failed ({len(result.failed)} failed: {', '.join(result.failed)})")
+                exit(1)
+    except SibsError as e:
+        print(f"Error: {e}")
+        exit(1)